@@ -8,8 +8,13 @@
 #
 
 import datetime as dt
+import hashlib
+import os
+import tempfile
 import numpy as np
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from math import pi
 from hpp.corbaserver.manipulation import (
     Client,
@@ -23,7 +28,7 @@ from hpp.corbaserver.manipulation.ur5 import Robot
 from hpp.gepetto.manipulation import ViewerFactory
 from hpp.corbaserver import loadServerPlugin
 from hpp_idl.hpp import Equality, EqualToZero
-from agimus_controller.trajectory_point import TrajectoryPoint
+from agimus_controller.trajectory_point import TrajectoryPointView
 from agimus_controller.hpp_panda.planner import Planner
 from agimus_controller.hpp_panda.scenes import Scene
 from agimus_controller.hpp_panda.wrapper_panda import PandaWrapper
@@ -46,8 +51,18 @@ class Ground(object):
 
 
 class HppInterface:
-    def __init__(self):
-        self.trajectory = []
+    def __init__(self, cache_directory=None, nb_sampling_threads=1):
+        """Interface to plan with HPP and sample its paths.
+
+        Args:
+            cache_directory (str, optional): Directory where the sampled paths are cached, no cache if None. Defaults to None.
+            nb_sampling_threads (int, optional): Number of threads sending the sampling requests to HPP concurrently. Defaults to 1.
+        """
+        self.x_plan = None
+        self.a_plan = None
+        self.nq = None
+        self.cache_directory = cache_directory
+        self.nb_sampling_threads = nb_sampling_threads
 
     def set_ur3_problem_solver(self, q_init):
         parser = ArgumentParser()
@@ -269,63 +284,121 @@ class HppInterface:
     def get_problem_solver_and_viewer(self):
         return self.ps, self.viewer
 
-    def get_hpp_x_a_planning(self, DT, nq, hpp_path):
-        path = hpp_path.pathAtRank(0)
-        T = int(np.round(path.length() / DT))
-        x_plan, a_plan, subpath = self.get_xplan_aplan(T, path, nq)
-        self.trajectory = subpath
-        whole_traj_T = T
-        for path_idx in range(1, hpp_path.numberPaths()):
+    def get_path_key(self, DT, nq, hpp_path, nb_key_samples=10):
+        """Return a key identifying the sampling of hpp_path.
+
+        The key hashes the length of each subpath and its configuration and
+        velocity at nb_key_samples evenly spaced times, extremities
+        included, for a replanned path with the same extremities and
+        length not to reuse a stale sampling.
+        """
+        description = [DT, nq]
+        for path_idx in range(hpp_path.numberPaths()):
             path = hpp_path.pathAtRank(path_idx)
-            T = int(np.round(path.length() / DT))
-            if T == 0:
-                continue
-            subpath_x_plan, subpath_a_plan, subpath = self.get_xplan_aplan(T, path, nq)
-            x_plan = np.concatenate([x_plan, subpath_x_plan], axis=0)
-            a_plan = np.concatenate([a_plan, subpath_a_plan], axis=0)
-            self.trajectory += subpath
-            whole_traj_T += T
+            description.append(path.length())
+            for time in np.linspace(0.0, path.length(), nb_key_samples):
+                description.append(list(path.call(time)[0]))
+                description.append(list(path.derivative(time, 1)))
+        return hashlib.sha1(repr(description).encode()).hexdigest()
+
+    def save_cache_file(self, cache_file, x_plan, a_plan):
+        """Save the plannings in cache_file, through a temporary file renamed once written for readers to never see a partial file."""
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=cache_file.parent, suffix=".npz.tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                np.savez(tmp_file, x_plan=x_plan, a_plan=a_plan)
+            os.replace(tmp_name, cache_file)
+        except BaseException:
+            os.remove(tmp_name)
+            raise
+
+    def get_hpp_x_a_planning(self, DT, nq, hpp_path):
+        """Return the state and acceleration plannings sampled every DT along hpp_path and their length.
+
+        If a cache directory is set, the samplings are saved in it and
+        loaded back instead of sampling the same path again.
+        """
+        cache_file = None
+        if self.cache_directory is not None:
+            key = self.get_path_key(DT, nq, hpp_path)
+            cache_file = Path(self.cache_directory) / f"{key}.npz"
+            if cache_file.exists():
+                with np.load(cache_file) as planning:
+                    x_plan, a_plan = planning["x_plan"], planning["a_plan"]
+                self.set_sampled_plannings(x_plan, a_plan, nq)
+                return x_plan, a_plan, x_plan.shape[0]
+
+        paths = [hpp_path.pathAtRank(idx) for idx in range(hpp_path.numberPaths())]
+        subpaths_T = [int(np.round(path.length() / DT)) for path in paths]
+        whole_traj_T = sum(subpaths_T)
+        x_plan = np.zeros([whole_traj_T, 2 * nq])
+        a_plan = np.zeros([whole_traj_T, nq])
+        # Each thread samples a contiguous block of nodes of a subpath, and
+        # writes it in its own rows of the plannings.
+        block_size = max(int(np.ceil(whole_traj_T / self.nb_sampling_threads)), 1)
+        blocks = []
+        start = 0
+        for path, T in zip(paths, subpaths_T):
+            times = self.get_sampling_times(T, path)
+            for block_start in range(0, T, block_size):
+                block_end = min(block_start + block_size, T)
+                block = slice(start + block_start, start + block_end)
+                block_times = times[block_start:block_end]
+                blocks.append((path, block_times, nq, x_plan[block], a_plan[block]))
+            start += T
+        with ThreadPoolExecutor(self.nb_sampling_threads) as executor:
+            for future in [executor.submit(self.fill_samples, *b) for b in blocks]:
+                future.result()
+        self.set_sampled_plannings(x_plan, a_plan, nq)
+
+        if cache_file is not None:
+            self.save_cache_file(cache_file, x_plan, a_plan)
         return x_plan, a_plan, whole_traj_T
 
+    def get_sampling_times(self, T, path):
+        """Return the times of the T samples of path."""
+        total_time = path.length()
+        if T == 1:
+            return [total_time]
+        return [total_time * iter / (T - 1) for iter in range(T)]  # iter * DT
+
+    def fill_xplan_aplan(self, T, path, nq, x_plan, a_plan):
+        """Fill x_plan and a_plan with T samples of the state and the acceleration along path."""
+        self.fill_samples(path, self.get_sampling_times(T, path), nq, x_plan, a_plan)
+
+    def fill_samples(self, path, times, nq, x_plan, a_plan):
+        """Fill x_plan and a_plan with the state and the acceleration of path at times."""
+        for iter, iter_time in enumerate(times):
+            x_plan[iter, :nq] = path.call(iter_time)[0][:nq]
+            x_plan[iter, nq:] = path.derivative(iter_time, 1)[:nq]
+            a_plan[iter, :] = path.derivative(iter_time, 2)[:nq]
+
+    def set_sampled_plannings(self, x_plan, a_plan, nq):
+        """Keep the last sampled plannings, from which the trajectory points are viewed."""
+        self.x_plan = x_plan
+        self.a_plan = a_plan
+        self.nq = nq
+
+    def get_trajectory_points(self, x_plan, a_plan, nq):
+        """Return the list of TrajectoryPointView on the rows of the state and acceleration plannings."""
+        return [
+            TrajectoryPointView(idx, x_plan[idx], a_plan[idx], nq)
+            for idx in range(x_plan.shape[0])
+        ]
+
     def get_xplan_aplan(self, T, path, nq):
         """Return x_plan the state and a_plan the acceleration of hpp's trajectory."""
         x_plan = np.zeros([T, 2 * nq])
         a_plan = np.zeros([T, nq])
-        subpath = []
-        trajectory_point = TrajectoryPoint()
-        trajectory_point.q = np.zeros(nq)
-        trajectory_point.v = np.zeros(nq)
-        trajectory_point.a = np.zeros(nq)
-        subpath = [trajectory_point]
-        if T == 0:
-            pass
-        elif T == 1:
-            time = path.length()
-            q_t = np.array(path.call(time)[0][:nq])
-            v_t = np.array(path.derivative(time, 1)[:nq])
-            x_plan[0, :] = np.concatenate([q_t, v_t])
-            a_t = np.array(path.derivative(time, 2)[:nq])
-            a_plan[0, :] = a_t
-            subpath[0].q[:] = q_t[:]
-            subpath[0].v[:] = v_t[:]
-            subpath[0].a[:] = a_t[:]
-        else:
-            total_time = path.length()
-            subpath = [TrajectoryPoint(t, nq, nq) for t in range(T)]
-            for iter in range(T):
-                iter_time = total_time * iter / (T - 1)  # iter * DT
-                q_t = np.array(path.call(iter_time)[0][:nq])
-                v_t = np.array(path.derivative(iter_time, 1)[:nq])
-                x_plan[iter, :] = np.concatenate([q_t, v_t])
-                a_t = np.array(path.derivative(iter_time, 2)[:nq])
-                a_plan[iter, :] = a_t
-                subpath[iter].q[:] = q_t[:]
-                subpath[iter].v[:] = v_t[:]
-                subpath[iter].a[:] = a_t[:]
-        return x_plan, a_plan, subpath
+        self.fill_xplan_aplan(T, path, nq, x_plan, a_plan)
+        return x_plan, a_plan, self.get_trajectory_points(x_plan, a_plan, nq)
 
     def get_trajectory_point(self, index):
-        return self.trajectory[index]
+        """Return a TrajectoryPointView on the node index of the last sampled plannings."""
+        return TrajectoryPointView(
+            index, self.x_plan[index], self.a_plan[index], self.nq
+        )
 
     def get_panda_q_init_q_goal(self):
         q_init = [
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+import time
+import timeit
+from threading import Event, Thread
+
+from agimus_controller.utils.period_jitter import PeriodJitter
+from agimus_controller.utils.solver_process import SolverProcess
+
+
+def solve_holding_gil(nb_iterations):
+    """Stand-in for a solve, the loop of sum running in C without releasing the GIL as the solvers do."""
+    return sum(range(nb_iterations))
+
+
+def publisher_loop(publish_period, duration):
+    """Return the jitter of a loop running at publish_period during duration."""
+    jitter = PeriodJitter(publish_period)
+    start = time.perf_counter()
+    next_time = start
+    while next_time - start < duration:
+        jitter.tick(time.perf_counter())
+        next_time += publish_period
+        time.sleep(max(next_time - time.perf_counter(), 0.0))
+    return jitter
+
+
+def solver_loop(solve, nb_iterations, stop):
+    while not stop.is_set():
+        solve(nb_iterations)
+
+
+def measure_jitter(solve, nb_iterations, publish_period, duration):
+    """Return the jitter of the publisher loop while solve runs in a thread, without solves if solve is None."""
+    stop = Event()
+    if solve is not None:
+        solver_thread = Thread(target=solver_loop, args=(solve, nb_iterations, stop))
+        solver_thread.start()
+    jitter = publisher_loop(publish_period, duration)
+    stop.set()
+    if solve is not None:
+        solver_thread.join()
+    return jitter
+
+
+if __name__ == "__main__":
+    publish_period = 1e-3
+    duration = 3.0
+    solve_duration = 20e-3
+    nb_iterations = 10**6
+    nb_iterations = int(
+        nb_iterations
+        * solve_duration
+        / timeit.timeit(lambda: solve_holding_gil(nb_iterations), number=1)
+    )
+    solver_process = SolverProcess(solve_holding_gil)
+    solves = {
+        "no solve": None,
+        "solver thread": solve_holding_gil,
+        "solver process": solver_process.solve,
+    }
+    print(
+        f"publish period {1e6 * publish_period:.0f} us, "
+        f"solves of {1e6 * solve_duration:.0f} us holding the GIL"
+    )
+    for name, solve in solves.items():
+        jitter = measure_jitter(solve, nb_iterations, publish_period, duration)
+        statistics = jitter.get_statistics()
+        print(
+            f"{name:>15} : period deviation mean {1e6 * statistics['mean']:8.2f} us, "
+            f"std {1e6 * statistics['std']:8.2f} us, "
+            f"max {1e6 * statistics['max']:8.2f} us"
+        )
+    solver_process.close()
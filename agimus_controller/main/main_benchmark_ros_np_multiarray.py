@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+import timeit
+import numpy as np
+from std_msgs.msg import Float64MultiArray, MultiArrayDimension
+
+from agimus_controller.utils.ros_np_multiarray import to_multiarray_f64, to_numpy_f64
+
+
+def to_multiarray_f64_loop(np_array):
+    """Element by element conversion, used as reference for the benchmark."""
+    multiarray = Float64MultiArray()
+    row_dim = MultiArrayDimension()
+    col_dim = MultiArrayDimension()
+    row_dim.label = "row"
+    col_dim.label = "col"
+    row_dim.stride = np_array.size
+    row_dim.size = np_array.shape[0]
+    col_dim.stride = np_array.shape[1]
+    col_dim.size = np_array.shape[1]
+    multiarray.layout.dim = [row_dim, col_dim]
+    multiarray.data = []
+    for i in range(np_array.shape[0]):
+        for j in range(np_array.shape[1]):
+            multiarray.data.append(np_array[i, j])
+    return multiarray
+
+
+if __name__ == "__main__":
+    number = 1000
+    for nx in [14, 28, 60]:
+        gain = np.random.rand(nx // 2, nx)
+        multiarray = to_multiarray_f64(gain)
+        assert np.array_equal(to_numpy_f64(multiarray), gain)
+        durations = {
+            "loop to multiarray": timeit.timeit(
+                lambda: to_multiarray_f64_loop(gain), number=number
+            ),
+            "to multiarray": timeit.timeit(
+                lambda: to_multiarray_f64(gain), number=number
+            ),
+            "to numpy": timeit.timeit(lambda: to_numpy_f64(multiarray), number=number),
+        }
+        print(f"feedback gain of shape {gain.shape}")
+        for name, duration in durations.items():
+            print(f"{name:>20} : {1e6 * duration / number:8.2f} us")
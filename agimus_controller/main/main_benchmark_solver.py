@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+import time
+import example_robot_data
+import numpy as np
+import pinocchio as pin
+
+from agimus_controller.ocps.ocp_croco_hpp import OCPCrocoHPP
+from agimus_controller.mpc import MPC
+from agimus_controller.utils.pin_utils import get_ee_pose_from_configuration
+
+
+def get_sinusoidal_planning(rmodel, whole_traj_T, DT):
+    """Return a smooth state and acceleration planning around the neutral configuration."""
+    t = np.arange(whole_traj_T)[:, np.newaxis] * DT
+    amplitude = 0.3
+    pulsation = 1.0
+    q = pin.neutral(rmodel) + amplitude * np.sin(pulsation * t)
+    v = amplitude * pulsation * np.cos(pulsation * t)
+    a = -amplitude * pulsation**2 * np.sin(pulsation * t)
+    return np.hstack([q, v]), a
+
+
+def benchmark_mpc_steps(rmodel, x_plan, a_plan, T, nb_ticks, persistent_solver):
+    """Return the durations of nb_ticks mpc steps and of the solver creation."""
+    armature = np.zeros(rmodel.nq)
+    ocp = OCPCrocoHPP(
+        rmodel,
+        use_constraints=False,
+        armature=armature,
+        persistent_solver=persistent_solver,
+    )
+    ocp.set_weights(10**4, 1, 10**-3, 0)
+    mpc = MPC(ocp, x_plan, a_plan, rmodel)
+    x, _ = mpc.mpc_first_step(x_plan[:T, :], a_plan[:T, :], x_plan[0, :], T)
+
+    ticks_duration = np.zeros(nb_ticks)
+    for tick in range(nb_ticks):
+        new_x_ref = x_plan[T + tick, :]
+        new_a_ref = a_plan[T + tick, :]
+        placement_ref = get_ee_pose_from_configuration(
+            ocp._rmodel, ocp._rdata, ocp._last_joint_frame_id, new_x_ref[: rmodel.nq]
+        )
+        start = time.perf_counter()
+        x, _ = mpc.mpc_step(x, new_x_ref, new_a_ref, placement_ref)
+        ticks_duration[tick] = time.perf_counter() - start
+
+    # Time spent allocating the solver workspace, saved at each tick in persistent mode.
+    problem = ocp.get_problem()
+    creation_duration = np.zeros(nb_ticks)
+    for tick in range(nb_ticks):
+        start = time.perf_counter()
+        ocp.create_solver(problem)
+        creation_duration[tick] = time.perf_counter() - start
+    return ticks_duration, creation_duration
+
+
+def print_durations(name, durations):
+    print(
+        f"{name:>28} : mean {1e3 * np.mean(durations):7.3f} ms,"
+        f" median {1e3 * np.median(durations):7.3f} ms,"
+        f" p99 {1e3 * np.percentile(durations, 99):7.3f} ms"
+    )
+
+
+if __name__ == "__main__":
+    robot = example_robot_data.load("ur3")
+    rmodel = robot.model
+    DT = 1e-2
+    nb_ticks = 200
+    for T in [50, 100, 200]:
+        x_plan, a_plan = get_sinusoidal_planning(rmodel, T + nb_ticks, DT)
+        print(f"horizon size T = {T}")
+        ticks_duration, creation_duration = benchmark_mpc_steps(
+            rmodel, x_plan, a_plan, T, nb_ticks, persistent_solver=False
+        )
+        print_durations("mpc step (new solver)", ticks_duration)
+        ticks_duration, _ = benchmark_mpc_steps(
+            rmodel, x_plan, a_plan, T, nb_ticks, persistent_solver=True
+        )
+        print_durations("mpc step (persistent solver)", ticks_duration)
+        print_durations("solver allocation", creation_duration)
@@ -59,21 +59,16 @@ if __name__ == "__main__":
             if buffer_size < 2 * T:
                 print(f"buffer size is {buffer_size}, waiting for {2*T} points.")
             else:
-                horizon_points = traj_buffer.get_points(T, point_attributes)
-                x_plan = np.zeros([T, mpc.nx])
-                a_plan = np.zeros([T, mpc.nv])
-                for idx_point, point in enumerate(horizon_points):
-                    x_plan[idx_point, :] = point.get_x_as_q_v()
-                    a_plan[idx_point, :] = point.a
+                x_plan, a_plan, _ = traj_buffer.get_horizon(T, point_attributes)
                 next_node_idx = T
                 x, u = mpc.mpc_first_step(x_plan, a_plan, x, T)
                 mpc_xs[idx - 2 * T, :] = x
                 mpc_us[idx - 2 * T - 1, :] = u
                 first_step_done = True
         else:
-            point = traj_buffer.get_points(1, point_attributes)[0]
-            new_x_ref = point.get_x_as_q_v()
-            new_a_ref = point.a
+            x_plan, a_plan, _ = traj_buffer.get_horizon(1, point_attributes)
+            new_x_ref = x_plan[0]
+            new_a_ref = a_plan[0]
             placement_ref = get_ee_pose_from_configuration(
                 mpc.ocp._rmodel,
                 mpc.ocp._rdata,
@@ -1,7 +1,36 @@
 from __future__ import annotations
 import numpy as np
+import pinocchio as pin
 
-from agimus_controller.utils.pin_utils import get_ee_pose_from_configuration
+from agimus_controller.mpc_data_recorder import MPCDataRecorder
+
+
+class TorqueBound:
+    def __init__(self, max_torque: float):
+        """Abort predicate of a simulation whose torques exceed max_torque in absolute value."""
+        self.max_torque = max_torque
+
+    def __call__(self, node_idx: int, xs: np.ndarray, us: np.ndarray) -> bool:
+        return np.max(np.abs(us)) > self.max_torque
+
+
+class TrackingErrorBound:
+    def __init__(self, x_plan: np.ndarray, nq: int, max_error: float):
+        """Abort predicate of a simulation whose configuration gets further than max_error from x_plan on a joint."""
+        self.x_plan = x_plan
+        self.nq = nq
+        self.max_error = max_error
+
+    def __call__(self, node_idx: int, xs: np.ndarray, us: np.ndarray) -> bool:
+        q_plan = self.x_plan[node_idx : node_idx + xs.shape[0], : self.nq]
+        return np.max(np.abs(xs[:, : self.nq] - q_plan)) > self.max_error
+
+
+class NaNDetection:
+    """Abort predicate of a simulation whose states or controls are not finite."""
+
+    def __call__(self, node_idx: int, xs: np.ndarray, us: np.ndarray) -> bool:
+        return not (np.all(np.isfinite(xs)) and np.all(np.isfinite(us)))
 
 
 class MPC:
@@ -29,14 +58,20 @@ class MPC:
         self.nx = self.nq + self.nv
         self.croco_xs = None
         self.croco_us = None
+        self.abort_reason = None
         self.whole_traj_T = x_plan.shape[0]
+        self.whole_placement_plan = None
+        self.whole_u_plan = None
+        self.simulation_model = None
+        self.simulation_data = None
 
-    def get_next_state(self, x, problem):
+    def get_next_state(self, x):
         """Get state at the next step by doing a crocoddyl integration."""
-        m = problem.runningModels[0]
-        d = m.createData()
-        m.calc(d, x, self.ocp.solver.us[0])
-        return d.xnext.copy()
+        if self.simulation_model is None:
+            self.simulation_model = self.ocp.get_simulation_model()
+            self.simulation_data = self.simulation_model.createData()
+        self.simulation_model.calc(self.simulation_data, x, self.ocp.solver.us[0])
+        return self.simulation_data.xnext.copy()
 
     def get_reference(self):
         model = self.ocp.solver.problem.runningModels[0]
@@ -52,91 +87,174 @@ class MPC:
         us = np.array(self.ocp.solver.us)
         return xs, us
 
-    def simulate_mpc(self, T, save_predictions=False, node_idx_breakpoint=None):
-        """Simulate mpc behavior using crocoddyl integration as a simulator."""
-        mpc_xs = np.zeros([self.whole_traj_T, 2 * self.nq])
-        mpc_us = np.zeros([self.whole_traj_T - 1, self.nq])
+    def simulate_mpc(
+        self,
+        T,
+        save_predictions=False,
+        node_idx_breakpoint=None,
+        nb_steps=None,
+        abort_predicates=None,
+        check_period=10,
+    ):
+        """Simulate mpc behavior using crocoddyl integration as a simulator.
+
+        Every check_period steps, the abort predicates are called with the
+        index of the first node simulated since the last check and the
+        states and controls simulated since then. When one of them returns
+        True, the simulation stops: croco_xs and croco_us only hold the
+        simulated nodes and abort_reason is set to the name of the predicate.
+
+        Args:
+            T (int): Number of nodes of the ocp horizon.
+            save_predictions (bool, optional): Record the predictions and references in the mpc_sim_data directory. Defaults to False.
+            node_idx_breakpoint (int, optional): Node at which a breakpoint is set. Defaults to None.
+            nb_steps (int, optional): Number of nodes of the simulated trajectory, the whole planning if None. Defaults to None.
+            abort_predicates (dict, optional): Callables (node_idx, xs, us) -> bool stopping the simulation, by name. Defaults to None.
+            check_period (int, optional): Number of steps between two checks of the abort predicates. Defaults to 10.
+
+        Returns:
+            str: Name of the predicate that stopped the simulation, None if it ran until the end.
+        """
+        if nb_steps is None:
+            nb_steps = self.whole_traj_T
+        mpc_xs = np.zeros([nb_steps, 2 * self.nq])
+        mpc_us = np.zeros([nb_steps - 1, self.nq])
         x0 = self.whole_x_plan[0, :]
         mpc_xs[0, :] = x0
 
         x_plan = self.whole_x_plan[:T, :]
         a_plan = self.whole_a_plan[:T, :]
-        x, u0 = self.mpc_first_step(x_plan, a_plan, x0, T)
+        if self.whole_placement_plan is None:
+            self.whole_placement_plan = self.ocp.get_placement_plan(self.whole_x_plan)
+        if self.whole_u_plan is None:
+            self.whole_u_plan = self.ocp.get_u_ref_table(
+                self.whole_x_plan, self.whole_a_plan
+            )
+        x, u0 = self.mpc_first_step(
+            x_plan,
+            a_plan,
+            x0,
+            T,
+            self.whole_placement_plan[:T],
+            self.whole_u_plan[: T - 1],
+        )
         mpc_xs[1, :] = x
         mpc_us[0, :] = u0
         next_node_idx = T
+        self.abort_reason = None
+        if abort_predicates is None:
+            abort_predicates = {}
+        last_check_idx = 0
 
         if save_predictions:
-            mpc_pred_xs = np.zeros([self.whole_traj_T, T, 2 * self.nq])
-            mpc_pred_us = np.zeros([self.whole_traj_T, T - 1, self.nq])
-            mpc_pred_xs[0, :, :] = np.array(self.ocp.solver.xs)
-            mpc_pred_us[0, :, :] = np.array(self.ocp.solver.us)
-            self.state_refs = np.zeros([self.whole_traj_T, 2 * self.nq])
-            self.translation_refs = np.zeros([self.whole_traj_T, 3])
-            self.control_refs = np.zeros([self.whole_traj_T, self.nq])
-            x_ref, p_ref, u_ref = self.get_reference()
-            self.state_refs[0, :] = x_ref
-            self.translation_refs[0, :] = p_ref
-            self.control_refs[0, :] = u_ref
-
-        for idx in range(1, self.whole_traj_T - 1):
-            x_plan = self.update_planning(x_plan, self.whole_x_plan[next_node_idx, :])
-            a_plan = self.update_planning(a_plan, self.whole_a_plan[next_node_idx, :])
-            placement_ref = get_ee_pose_from_configuration(
-                self.ocp._rmodel,
-                self.ocp._rdata,
-                self.ocp._last_joint_frame_id,
-                x_plan[-1, : self.nq],
+            recorder = self.create_data_recorder("mpc_sim_data")
+            self.record_predictions_and_refs(recorder)
+
+        # The horizon slides over the whole planning by incrementing next_node_idx,
+        # the node entering the horizon being read in place in the whole planning.
+        for idx in range(1, nb_steps - 1):
+            placement_ref = pin.SE3(self.whole_placement_plan[next_node_idx])
+            x, u = self.mpc_step(
+                x,
+                self.whole_x_plan[next_node_idx, :],
+                self.whole_a_plan[next_node_idx, :],
+                placement_ref,
+                self.whole_u_plan[next_node_idx],
             )
-            x, u = self.mpc_step(x, x_plan[-1], a_plan[-1], placement_ref)
             if next_node_idx < self.whole_x_plan.shape[0] - 1:
                 next_node_idx += 1
             mpc_xs[idx + 1, :] = x
             mpc_us[idx, :] = u
 
             if save_predictions:
-                mpc_pred_xs[idx, :, :] = np.array(self.ocp.solver.xs)
-                mpc_pred_us[idx, :, :] = np.array(self.ocp.solver.us)
-                x_ref, p_ref, u_ref = self.get_reference()
-                self.state_refs[idx, :] = x_ref
-                self.translation_refs[idx, :] = p_ref
-                self.control_refs[idx, :] = u_ref
+                self.record_predictions_and_refs(recorder)
 
             if idx == node_idx_breakpoint:
                 breakpoint()
+
+            if abort_predicates and (idx % check_period == 0 or idx == nb_steps - 2):
+                self.abort_reason = self.check_abort_predicates(
+                    abort_predicates,
+                    last_check_idx,
+                    mpc_xs[last_check_idx : idx + 2],
+                    mpc_us[last_check_idx : idx + 1],
+                )
+                last_check_idx = idx + 1
+                if self.abort_reason is not None:
+                    mpc_xs = mpc_xs[: idx + 2]
+                    mpc_us = mpc_us[: idx + 1]
+                    break
         self.croco_xs = mpc_xs
         self.croco_us = mpc_us
         if save_predictions:
-            print("saving predictions in .npy files")
-            np.save("mpc_xs_sim.npy", mpc_pred_xs, allow_pickle=True)
-            np.save("mpc_us_sim.npy", mpc_pred_us, allow_pickle=True)
-            np.save("state_refs_sim.npy", self.state_refs)
-            np.save("translation_refs_sim.npy", self.translation_refs)
-            np.save("control_refs_sim.npy", self.control_refs)
-
-    def update_planning(self, planning_vec, next_value):
-        """Update numpy array by removing the first value and adding next_value at the end."""
-        planning_vec = np.delete(planning_vec, 0, 0)
-        return np.r_[planning_vec, next_value[np.newaxis, :]]
+            print("saving predictions in mpc_sim_data directory")
+            recorder.close()
+        return self.abort_reason
+
+    def check_abort_predicates(self, abort_predicates, node_idx, xs, us):
+        """Return the name of the first abort predicate true on the states and controls from node_idx, None if there is none."""
+        for name, predicate in abort_predicates.items():
+            if predicate(node_idx, xs, us):
+                return name
+        return None
+
+    def create_data_recorder(self, directory, chunk_size=1000):
+        """Return a recorder of the predictions and references of the current ocp."""
+        T = self.ocp.T
+        fields = {
+            "preds_xs": (T, self.nx),
+            "preds_us": (T - 1, self.nv),
+            "state_refs": (self.nx,),
+            "translation_refs": (3,),
+            "control_refs": (self.nv,),
+        }
+        return MPCDataRecorder(directory, fields, chunk_size)
+
+    def record_predictions_and_refs(self, recorder: MPCDataRecorder):
+        """Record the solver predictions and the references of the first node."""
+        x_ref, p_ref, u_ref = self.get_reference()
+        recorder.record(
+            preds_xs=self.ocp.solver.xs,
+            preds_us=self.ocp.solver.us,
+            state_refs=x_ref,
+            translation_refs=p_ref,
+            control_refs=u_ref,
+        )
 
     def get_mpc_output(self):
         return self.ocp.solver.problem.x0, self.ocp.solver.us[0], self.ocp.solver.K[0]
 
-    def mpc_first_step(self, x_plan, a_plan, x0, T):
-        """Create crocoddyl problem from planning, run solver and get new state."""
-        problem = self.ocp.build_ocp_from_plannif(x_plan, a_plan, x0)
+    def mpc_first_step(self, x_plan, a_plan, x0, T, placement_plan=None, u_plan=None):
+        """Create crocoddyl problem from planning, run solver and get new state.
+
+        The end effector placements and the control references of the
+        horizon are computed from the planning if they are not given.
+        """
+        problem = self.ocp.build_ocp_from_plannif(
+            x_plan, a_plan, x0, placement_plan, u_plan
+        )
         self.ocp.run_solver(problem, list(x_plan), list(self.ocp.u_plan[: T - 1]), 1000)
-        x = self.get_next_state(x0, self.ocp.solver.problem)
+        x = self.get_next_state(x0)
         return x, self.ocp.solver.us[0]
 
-    def mpc_step(self, x0, new_x_ref, new_a_ref, placement_ref):
-        """Reset ocp, run solver and get new state."""
-        u_ref_terminal_node = self.ocp.get_inverse_dynamic_control(new_x_ref, new_a_ref)
+    def mpc_step(self, x0, new_x_ref, new_a_ref, placement_ref, new_u_ref=None):
+        """Reset ocp, run solver and get new state.
+
+        new_u_ref is the control reference of the new terminal node, computed
+        by inverse dynamics if it has not been precomputed.
+        """
+        if new_u_ref is None:
+            u_ref_terminal_node = self.ocp.get_inverse_dynamic_control(
+                new_x_ref, new_a_ref
+            )
+        else:
+            u_ref_terminal_node = new_u_ref
         self.ocp.reset_ocp(x0, new_x_ref, u_ref_terminal_node[: self.nq], placement_ref)
         xs_init = list(self.ocp.solver.xs[1:]) + [self.ocp.solver.xs[-1]]
         xs_init[0] = x0
         us_init = list(self.ocp.solver.us[1:]) + [self.ocp.solver.us[-1]]
-        self.ocp.solver.problem.x0 = x0
-        self.ocp.run_solver(self.ocp.solver.problem, xs_init, us_init, 1)
-        x0 = self.get_next_state(x0, self.ocp.solver.problem)
+        problem = self.ocp.get_problem()
+        problem.x0 = x0
+        self.ocp.run_solver(problem, xs_init, us_init, 1)
+        x0 = self.get_next_state(x0)
         return x0, self.ocp.solver.us[0]
@@ -0,0 +1,78 @@
+from __future__ import annotations
+import numpy as np
+from pathlib import Path
+from threading import Thread
+
+
+class MPCDataRecorder:
+    """Record fixed-size MPC data in chunks saved on disk, with a bounded memory footprint."""
+
+    def __init__(self, directory, fields: dict[str, tuple], chunk_size: int = 1000):
+        """Preallocate the chunks in which the records are written.
+
+        Args:
+            directory (str): Directory in which the chunks are saved, previous chunks are removed.
+            fields (dict[str, tuple]): Shape of one record of each field.
+            chunk_size (int, optional): Number of records of a chunk. Defaults to 1000.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for file in self.directory.glob("chunk_*.npz"):
+            file.unlink()
+        self.chunk_size = chunk_size
+
+        # One chunk is filled while the other one is saved on disk.
+        self._chunks = [
+            {name: np.zeros((chunk_size, *shape)) for name, shape in fields.items()}
+            for _ in range(2)
+        ]
+        self._chunk_idx = 0
+        self._chunk = self._chunks[0]
+        self._nb_records = 0
+        self._writer = None
+
+    def record(self, **values):
+        """Write one record of each given field, the chunk is saved when full."""
+        for name, value in values.items():
+            self._chunk[name][self._nb_records] = value
+        self._nb_records += 1
+        if self._nb_records == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Save the current chunk in a background thread and switch to the other one."""
+        if self._nb_records == 0:
+            return
+        self._wait_writer()
+        file = self.directory / f"chunk_{self._chunk_idx:06d}.npz"
+        self._writer = Thread(
+            target=self._save_chunk, args=(file, self._chunk, self._nb_records)
+        )
+        self._writer.start()
+        self._chunk_idx += 1
+        self._chunk = self._chunks[self._chunk_idx % 2]
+        self._nb_records = 0
+
+    def close(self):
+        """Save the remaining records and wait until everything is written."""
+        self.flush()
+        self._wait_writer()
+
+    def _wait_writer(self):
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+
+    @staticmethod
+    def _save_chunk(file, chunk, nb_records):
+        np.savez(file, **{name: array[:nb_records] for name, array in chunk.items()})
+
+    @staticmethod
+    def load(directory) -> dict[str, np.ndarray]:
+        """Return the records of all the chunks saved in directory, concatenated by field."""
+        datas = {}
+        for file in sorted(Path(directory).glob("chunk_*.npz")):
+            with np.load(file) as chunk:
+                for name in chunk.files:
+                    datas.setdefault(name, []).append(chunk[name])
+        return {name: np.concatenate(arrays) for name, arrays in datas.items()}
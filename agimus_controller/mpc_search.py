@@ -1,9 +1,104 @@
 import time
 import numpy as np
-from .mpc import MPC
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .mpc import MPC, NaNDetection, TorqueBound
+from .ocps.ocp_croco_hpp import OCPCrocoHPP
+from .utils.trajectory_metrics import (
+    get_ee_deviation,
+    get_ee_translations,
+    get_max_torque_increment,
+    get_tracking_error,
+    get_trajectory_metrics,
+)
 import pinocchio as pin
 
 
+class MPCSearchConfig:
+    def __init__(
+        self,
+        rmodel: pin.Model,
+        cmodel: pin.GeometryModel,
+        x_plan: np.ndarray,
+        a_plan: np.ndarray,
+        T: int,
+        use_constraints: bool = False,
+        armature: np.ndarray = None,
+        DT: float = None,
+        weights: list = None,
+        persistent_solver: bool = False,
+    ):
+        """Picklable description of the mpc simulated for each weights combination in a worker process.
+
+        MPCSearch.create_config builds it from the mpc of the search, for the
+        workers to simulate the same mpc as the sequential search.
+
+        Args:
+            rmodel (pin.Model): Pinocchio model of the robot.
+            cmodel (pin.GeometryModel): Pinocchio geometry model of the robot.
+            x_plan (np.ndarray): State planification of HPP.
+            a_plan (np.ndarray): Acceleration planification of HPP.
+            T (int): Number of nodes of the ocp horizon.
+            use_constraints (bool, optional): Activate collision avoidance constraints. Defaults to False.
+            armature (np.ndarray, optional): Armature of the robot. Defaults to None.
+            DT (float, optional): Time step of the ocp, the default one of OCPCrocoHPP if None. Defaults to None.
+            weights (list, optional): [ee_placement, x_reg, u_reg, vel_reg] weights of the ocp, the default ones of OCPCrocoHPP if None. Defaults to None.
+            persistent_solver (bool, optional): Keep the solver created for a problem and only re-solve it. Defaults to False.
+        """
+        self.rmodel = rmodel
+        self.cmodel = cmodel
+        self.x_plan = x_plan
+        self.a_plan = a_plan
+        self.T = T
+        self.use_constraints = use_constraints
+        self.armature = armature
+        self.DT = DT
+        self.weights = weights
+        self.persistent_solver = persistent_solver
+
+    def create_mpc(self) -> MPC:
+        """Build a new ocp and its mpc from the config."""
+        ocp = OCPCrocoHPP(
+            self.rmodel,
+            self.cmodel,
+            self.use_constraints,
+            self.armature,
+            self.persistent_solver,
+        )
+        if self.DT is not None:
+            ocp.DT = self.DT
+        if self.weights is not None:
+            ocp.set_weights(*self.weights)
+        return MPC(ocp, self.x_plan, self.a_plan, self.rmodel, self.cmodel)
+
+
+def simulate_combination(
+    config: MPCSearchConfig,
+    combination,
+    nb_steps=None,
+    abort_predicates=None,
+    check_period=10,
+):
+    """Simulate in a new mpc the weights combination, run in the worker processes of MPCSearch.
+
+    Only the first nb_steps nodes of the planning are simulated, the whole
+    planning if None. The simulation stops early if one of the
+    abort_predicates is true, see MPC.simulate_mpc.
+    """
+    mpc = config.create_mpc()
+    grip_cost, x_cost, u_cost, vel_cost, _ = combination
+    # As in the sequential search, the weights of the config, which are the
+    # ones of the ocp of the search, are kept when using constraints.
+    if not config.use_constraints:
+        mpc.ocp.set_weights(grip_cost, x_cost, u_cost, vel_cost)
+    mpc.simulate_mpc(
+        config.T,
+        nb_steps=nb_steps,
+        abort_predicates=abort_predicates,
+        check_period=check_period,
+    )
+    return mpc.croco_xs, mpc.croco_us, mpc.abort_reason
+
+
 class MPCSearch:
     def __init__(self, mpc: MPC, rmodel, ee_frame_name):
         self.mpc = mpc
@@ -16,80 +111,85 @@ class MPCSearch:
         self._id_ee_frame_name = self._rmodel.getFrameId(self._ee_frame_name)
         self.croco_xs = None
         self.croco_us = None
+        self.hpp_ee_translations = None
+        self.metrics = None
         self.results = {}
         self.results["xs"] = []
         self.results["us"] = []
         self.results["max_us"] = []
         self.results["max_increase_us"] = []
         self.results["combination"] = []
+        self.results["metrics"] = []
+        self.results["abort_reason"] = []
+        self.max_us_bound = 100
+        self.max_increase_us_bound = 50
+        self.abort_predicates = None
+        self.abort_check_period = 10
+
+    def use_early_abort(self, check_period=10):
+        """Stop the simulations of the searches as soon as their torques exceed max_us_bound or they diverge.
+
+        The aborted combinations are added to the results with their partial
+        trajectory and the name of the predicate that stopped them, and are
+        never selected as the best combination.
+        """
+        self.abort_predicates = {
+            "max_us": TorqueBound(self.max_us_bound),
+            "nan": NaNDetection(),
+        }
+        self.abort_check_period = check_period
 
     def get_trajectory_difference(self, configuration_traj=True):
         """Compute at each node the absolute difference in position either in cartesian or configuration space and sum it."""
         if configuration_traj:
-            traj_croco = self.croco_xs[:, : self.nq]
-            traj_hpp = self.whole_x_plan[:, : self.nq]
-        else:
-            traj_croco, traj_hpp = self.get_cartesian_trajectory()
-        diffs = []
-        for idx in range(len(traj_croco)):
-            array_diff = np.abs(np.array(traj_croco[idx]) - np.array(traj_hpp[idx]))
-            diffs.append(np.sum(array_diff))
-        return sum(diffs)
+            return get_tracking_error(self.croco_xs, self.whole_x_plan, self.nq)
+        return get_ee_deviation(
+            self.get_croco_ee_translations(), self.get_hpp_ee_translations()
+        )
 
     def max_increase_us(self):
         """Return control max increase"""
-        increases = np.zeros([self.croco_us.shape[0] - 1, self.nq])
-        for joint_idx in range(self.nq):
-            for idx in range(self.croco_us.shape[0] - 1):
-                increases[idx, joint_idx] = (
-                    self.croco_us[idx + 1, joint_idx] - self.croco_us[idx, joint_idx]
-                )
-        return np.max(np.abs(increases)), np.unravel_index(
-            np.argmax(np.abs(increases), axis=None), increases.shape
+        return get_max_torque_increment(self.croco_us)
+
+    def get_croco_ee_translations(self):
+        """Return the (N, 3) array of gripper translations of the trajectory found by crocoddyl."""
+        return get_ee_translations(
+            self._rmodel,
+            self._rdata,
+            self._id_ee_frame_name,
+            self.croco_xs[:, : self.nq],
         )
 
+    def get_hpp_ee_translations(self):
+        """Return the (N, 3) array of gripper translations of the trajectory found by hpp, computed once."""
+        if self.hpp_ee_translations is None:
+            self.hpp_ee_translations = get_ee_translations(
+                self._rmodel,
+                self._rdata,
+                self._id_ee_frame_name,
+                self.whole_x_plan[:, : self.nq],
+            )
+        return self.hpp_ee_translations
+
     def get_cartesian_trajectory(self):
-        """Return the vector of gripper pose for both trajectories found by hpp and crocoddyl."""
-        pose_croco = [[] for _ in range(3)]
-        pose_hpp = [[] for _ in range(3)]
-        for idx in range(self.croco_xs.shape[0]):
-            q = self.croco_xs[idx, : self.nq]
-            pose = self._get_ee_pose_from_configuration(q).translation
-            for idx in range(3):
-                pose_croco[idx].append(pose[idx])
-        for idx in range(self.whole_x_plan.shape[0]):
-            q = self.whole_x_plan[idx, : self.nq]
-            pose = self._get_ee_pose_from_configuration(q).translation
-            for idx in range(3):
-                pose_hpp[idx].append(pose[idx])
+        """Return the (3, N) arrays of gripper pose for both trajectories found by hpp and crocoddyl.
+
+        Only the nodes simulated by the mpc are returned for hpp's trajectory.
+        """
+        pose_croco = self.get_croco_ee_translations().T
+        pose_hpp = self.get_hpp_ee_translations()[: self.croco_xs.shape[0]].T
         return pose_croco, pose_hpp
 
-    def search_best_costs(self, use_constraints=False, configuration_traj=False):
-        """Search costs that minimize the gap between hpp and crocoddyl trajectories."""
-        self.best_combination = None
-        self.best_croco_xs = None
-        self.best_croco_us = None
-        self.best_diff = 1e6
-        grip_cost = 0
-        self.mpc.ocp.use_constraints = use_constraints
+    def get_combinations(self, use_constraints=False):
+        """Return the list of [grip_cost, x_cost, u_cost, vel_cost, xlim_cost] weights combinations of the search grid."""
+        combinations = []
         if use_constraints:
             for x_exponent in range(0, 8, 2):
                 for u_exponent in range(-32, -26, 2):
-                    start = time.time()
                     _, x_cost, u_cost, _, _ = self.get_cost_from_exponent(
                         0, x_exponent, u_exponent, 0, 0
                     )
-                    print(" x : ", x_cost, " u : ", u_cost)
-                    self.try_new_costs(
-                        grip_cost,
-                        x_cost,
-                        u_cost,
-                        configuration_traj=configuration_traj,
-                        vel_cost=0,
-                        xlim_cost=0,
-                    )
-                    end = time.time()
-                    print("mpc simulation duration ", end - start)
+                    combinations.append([0, x_cost, u_cost, 0, 0])
         else:
             for grip_exponent in range(25, 50, 5):
                 for x_exponent in range(0, 15, 5):
@@ -97,33 +197,206 @@ class MPCSearch:
                         grip_cost, x_cost, u_cost, _, _ = self.get_cost_from_exponent(
                             grip_exponent, x_exponent, u_exponent, 0, 0
                         )
-                        print(
-                            "weights pose : ",
-                            grip_cost,
-                            " x : ",
-                            x_cost,
-                            " u : ",
-                            u_cost,
-                        )
-                        self.mpc.ocp.set_weights(grip_cost, x_cost, u_cost, 0)
-                        start = time.time()
-                        self.try_new_costs(
-                            grip_cost,
-                            x_cost,
-                            u_cost,
-                            configuration_traj=configuration_traj,
-                            vel_cost=0,
-                            xlim_cost=0,
-                        )
-                        end = time.time()
-                        print("mpc simulation duration ", end - start)
+                        combinations.append([grip_cost, x_cost, u_cost, 0, 0])
+        return combinations
+
+    def create_config(self, T=100) -> MPCSearchConfig:
+        """Return the description of the mpc of the search, with its planning, ocp parameters and current weights."""
+        ocp = self.mpc.ocp
+        return MPCSearchConfig(
+            self._rmodel,
+            ocp._cmodel,
+            self.whole_x_plan,
+            self.whole_a_plan,
+            T,
+            ocp.use_constraints,
+            ocp.armature,
+            ocp.DT,
+            [
+                ocp._weight_ee_placement,
+                ocp._weight_x_reg,
+                ocp._weight_u_reg,
+                ocp._weight_vel_reg,
+            ],
+            ocp.persistent_solver,
+        )
+
+    def check_config(self, config: MPCSearchConfig):
+        """Raise a ValueError if the planning or the time step of config differ from the ones of the search."""
+        if not (
+            np.array_equal(config.x_plan, self.whole_x_plan)
+            and np.array_equal(config.a_plan, self.whole_a_plan)
+        ):
+            raise ValueError("the planning of the config is not the one of the search")
+        if config.DT is not None and config.DT != self.mpc.ocp.DT:
+            raise ValueError(
+                f"the time step of the config is {config.DT} "
+                f"instead of {self.mpc.ocp.DT}"
+            )
+
+    def search_best_costs_parallel(
+        self,
+        config: MPCSearchConfig = None,
+        configuration_traj=False,
+        max_workers=None,
+    ):
+        """Search costs that minimize the gap between hpp and crocoddyl trajectories, simulating each combination in a worker process.
+
+        Args:
+            config (MPCSearchConfig, optional): Description of the mpc built in each worker, built from the mpc of the search if None. Defaults to None.
+            configuration_traj (bool, optional): Compare the trajectories in configuration space instead of cartesian space. Defaults to False.
+            max_workers (int, optional): Number of worker processes, the number of processors if None. Defaults to None.
+        """
+        if config is None:
+            config = self.create_config()
+        self.check_config(config)
+        self.reset_best()
+        combinations = self.get_combinations(config.use_constraints)
+        solutions = self.simulate_combinations(config, combinations, max_workers)
+        # Results are added in the grid order, for the best combination to be
+        # the same as with the sequential search.
+        for combination, (croco_xs, croco_us, abort_reason) in zip(
+            combinations, solutions
+        ):
+            self.add_result(
+                croco_xs, croco_us, *combination, configuration_traj, abort_reason
+            )
+        self.set_best_solution()
 
+    def search_best_costs_adaptive(
+        self,
+        config: MPCSearchConfig = None,
+        configuration_traj=False,
+        max_workers=None,
+        first_fraction=0.2,
+        reduction_factor=2,
+    ):
+        """Search costs that minimize the gap between hpp and crocoddyl trajectories by successive halving.
+
+        All the combinations are first simulated on the first_fraction of the
+        planning. After each round, the combinations exceeding the torque
+        bounds are pruned, since these maxima can only grow with longer
+        simulations, and only the best 1 / reduction_factor of the others are
+        simulated again on a reduction_factor times longer part of the
+        planning, until the whole planning is simulated.
+
+        Args:
+            config (MPCSearchConfig, optional): Description of the mpc built in each worker, built from the mpc of the search if None. Defaults to None.
+            configuration_traj (bool, optional): Compare the trajectories in configuration space instead of cartesian space. Defaults to False.
+            max_workers (int, optional): Number of worker processes, the number of processors if None. Defaults to None.
+            first_fraction (float, optional): Fraction of the planning simulated in the first round. Defaults to 0.2.
+            reduction_factor (int, optional): Factor by which the number of combinations is reduced and the simulation length increased at each round. Defaults to 2.
+        """
+        if config is None:
+            config = self.create_config()
+        self.check_config(config)
+        self.reset_best()
+        whole_traj_T = config.x_plan.shape[0]
+        combinations = self.get_combinations(config.use_constraints)
+        fraction = first_fraction
+        nb_simulated_nodes = 0
+        while True:
+            nb_steps = min(max(int(np.ceil(fraction * whole_traj_T)), 2), whole_traj_T)
+            print(f"simulating {len(combinations)} combinations on {nb_steps} nodes")
+            solutions = self.simulate_combinations(
+                config, combinations, max_workers, nb_steps
+            )
+            nb_simulated_nodes += nb_steps * len(combinations)
+            if nb_steps == whole_traj_T:
+                break
+            diffs = {}
+            for idx, (croco_xs, croco_us, abort_reason) in enumerate(solutions):
+                if abort_reason is not None:
+                    continue
+                diff, max_us, max_increase_us = self.evaluate(
+                    croco_xs, croco_us, configuration_traj
+                )
+                if self.is_admissible(max_us, max_increase_us):
+                    diffs[idx] = diff
+            nb_kept = int(np.ceil(len(diffs) / reduction_factor))
+            kept = sorted(sorted(diffs, key=diffs.get)[:nb_kept])
+            combinations = [combinations[idx] for idx in kept]
+            if len(combinations) == 0:
+                print("no combination respects the torque bounds")
+                return
+            fraction *= reduction_factor
+        for combination, (croco_xs, croco_us, abort_reason) in zip(
+            combinations, solutions
+        ):
+            self.add_result(
+                croco_xs, croco_us, *combination, configuration_traj, abort_reason
+            )
+        print(
+            "simulated nodes ",
+            nb_simulated_nodes,
+            " instead of ",
+            whole_traj_T * len(self.get_combinations(config.use_constraints)),
+        )
+        self.set_best_solution()
+
+    def simulate_combinations(
+        self, config: MPCSearchConfig, combinations, max_workers=None, nb_steps=None
+    ):
+        """Return the (croco_xs, croco_us, abort_reason) of each combination, simulated in worker processes, and print the progress."""
+        solutions = [None] * len(combinations)
+        start = time.time()
+        with ProcessPoolExecutor(max_workers) as executor:
+            futures = {
+                executor.submit(
+                    simulate_combination,
+                    config,
+                    combination,
+                    nb_steps,
+                    self.abort_predicates,
+                    self.abort_check_period,
+                ): idx
+                for idx, combination in enumerate(combinations)
+            }
+            for nb_done, future in enumerate(as_completed(futures), start=1):
+                solutions[futures[future]] = future.result()
+                elapsed = time.time() - start
+                eta = elapsed / nb_done * (len(combinations) - nb_done)
+                print(
+                    f"combination {nb_done}/{len(combinations)}, "
+                    f"elapsed {elapsed:.1f} s, eta {eta:.1f} s"
+                )
+        return solutions
+
+    def reset_best(self):
+        self.best_combination = None
+        self.best_croco_xs = None
+        self.best_croco_us = None
+        self.best_diff = 1e6
+
+    def set_best_solution(self):
         self.croco_xs = self.best_croco_xs
         self.croco_us = self.best_croco_us
         print("best diff ", self.best_diff)
         print("best combination ", self.best_combination)
         print("max torque ", np.max(np.abs(self.croco_us)))
 
+    def search_best_costs(self, use_constraints=False, configuration_traj=False):
+        """Search costs that minimize the gap between hpp and crocoddyl trajectories."""
+        self.reset_best()
+        self.mpc.ocp.use_constraints = use_constraints
+        for combination in self.get_combinations(use_constraints):
+            grip_cost, x_cost, u_cost, vel_cost, xlim_cost = combination
+            print("weights pose : ", grip_cost, " x : ", x_cost, " u : ", u_cost)
+            if not use_constraints:
+                self.mpc.ocp.set_weights(grip_cost, x_cost, u_cost, vel_cost)
+            start = time.time()
+            self.try_new_costs(
+                grip_cost,
+                x_cost,
+                u_cost,
+                configuration_traj=configuration_traj,
+                vel_cost=vel_cost,
+                xlim_cost=xlim_cost,
+            )
+            end = time.time()
+            print("mpc simulation duration ", end - start)
+        self.set_best_solution()
+
     def get_cost_from_exponent(
         self, grip_exponent, x_exponent, u_exponent, vel_exponent=0, xlim_exponent=0
     ):
@@ -145,31 +418,96 @@ class MPCSearch:
         configuration_traj=False,
     ):
         """Set problem, run solver, add result in dict and check if we found a better solution."""
-        self.mpc.simulate_mpc(100)
-        self.croco_xs = self.mpc.croco_xs
-        self.croco_us = self.mpc.croco_us
-        max_us = np.max(np.abs(self.croco_us))
-        max_increase_us, _ = self.max_increase_us()
+        abort_reason = self.mpc.simulate_mpc(
+            100,
+            abort_predicates=self.abort_predicates,
+            check_period=self.abort_check_period,
+        )
+        self.add_result(
+            self.mpc.croco_xs,
+            self.mpc.croco_us,
+            grip_cost,
+            x_cost,
+            u_cost,
+            vel_cost,
+            xlim_cost,
+            configuration_traj,
+            abort_reason,
+        )
+
+    def add_result(
+        self,
+        croco_xs,
+        croco_us,
+        grip_cost,
+        x_cost,
+        u_cost,
+        vel_cost=0,
+        xlim_cost=0,
+        configuration_traj=False,
+        abort_reason=None,
+    ):
+        """Add the simulated trajectory of a combination in results and check if it is a better solution.
+
+        A trajectory whose simulation was aborted is never the best solution.
+        """
+        diff, max_us, max_increase_us = self.evaluate(
+            croco_xs, croco_us, configuration_traj
+        )
         self.results["xs"].append(self.croco_xs)
         self.results["us"].append(self.croco_us)
         self.results["max_us"].append(max_us)
         self.results["max_increase_us"].append(max_increase_us)
+        self.results["metrics"].append(self.metrics)
+        self.results["abort_reason"].append(abort_reason)
         self.results["combination"].append(
             [grip_cost, x_cost, u_cost, vel_cost, xlim_cost]
         )
-        diff = self.get_trajectory_difference(configuration_traj)
-        if diff < self.best_diff and max_us < 100 and max_increase_us < 50:
+        if (
+            abort_reason is None
+            and diff < self.best_diff
+            and self.is_admissible(max_us, max_increase_us)
+        ):
             self.best_combination = [grip_cost, x_cost, u_cost, vel_cost, xlim_cost]
             self.best_diff = diff
             self.best_croco_xs = self.croco_xs
             self.best_croco_us = self.croco_us
 
-    def _get_ee_pose_from_configuration(self, q: np.ndarray):
-        """Returns the SE3 describing the position of the end effector of the robot.
+    def evaluate(self, croco_xs, croco_us, configuration_traj=False):
+        """Set the simulated trajectory and return its difference with hpp's one, its max torque and max torque increase.
 
-        Args:
-            q (np.ndarray): configuration of the robot
+        All the metrics of the trajectory are computed at once and kept in
+        self.metrics. The end effector deviation, which needs a forward
+        kinematics pass, is only computed when comparing in cartesian space.
         """
-        pin.framesForwardKinematics(self._rmodel, self._rdata, q)
-        pose = self._rdata.oMf[self._id_ee_frame_name]
-        return pose
+        self.croco_xs = croco_xs
+        self.croco_us = croco_us
+        if configuration_traj:
+            self.metrics = get_trajectory_metrics(
+                self.croco_xs,
+                self.croco_us,
+                self.whole_x_plan,
+                self.nq,
+                self.mpc.ocp.DT,
+            )
+            diff = self.metrics["tracking_error"]
+        else:
+            self.metrics = get_trajectory_metrics(
+                self.croco_xs,
+                self.croco_us,
+                self.whole_x_plan,
+                self.nq,
+                self.mpc.ocp.DT,
+                self._rmodel,
+                self._rdata,
+                self._id_ee_frame_name,
+                self.get_hpp_ee_translations(),
+            )
+            diff = self.metrics["ee_deviation"]
+        return diff, self.metrics["max_torque"], self.metrics["max_torque_increment"]
+
+    def is_admissible(self, max_us, max_increase_us):
+        """Return True if the torques of a trajectory respect the bounds of the search."""
+        return (
+            max_us < self.max_us_bound and max_increase_us < self.max_increase_us_bound
+        )
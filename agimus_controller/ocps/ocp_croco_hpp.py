@@ -6,6 +6,7 @@ import mim_solvers
 from colmpc import ResidualDistanceCollision
 
 from agimus_controller.utils.pin_utils import (
+    get_ee_placements_from_trajectory,
     get_ee_pose_from_configuration,
     get_last_joint,
 )
@@ -18,6 +19,7 @@ class OCPCrocoHPP:
         cmodel: pin.GeometryModel = None,
         use_constraints: bool = False,
         armature: np.ndarray = None,
+        persistent_solver: bool = False,
     ) -> None:
         """Class to define the OCP linked witha HPP generated trajectory.
 
@@ -26,6 +28,7 @@ class OCPCrocoHPP:
             cmodel (pin.GeometryModel): Pinocchio geometry model of the robot. Must have been convexified for the collisions to work.
             use_constraints : boolean to activate collision avoidance constraints.
             armature : armature of the robot.
+            persistent_solver : boolean to keep the solver created for a problem and only re-solve it in the next calls.
 
         Raises:
             Exception: Unkown robot.
@@ -68,6 +71,7 @@ class OCPCrocoHPP:
         self.x_plan = None
         self.a_plan = None
         self.u_plan = None
+        self.placement_plan = None
         self.T = None
 
         # Creating the running and terminal models
@@ -76,37 +80,49 @@ class OCPCrocoHPP:
 
         # Solver used for the OCP
         self.solver = None
+        self.persistent_solver = persistent_solver
+        self._solver_problem = None
 
-    def get_u_plan(
+    def get_u_ref_table(
         self, x_plan: np.ndarray, a_plan: np.ndarray, using_gravity=False
     ) -> np.ndarray:
-        """Return the reference of control u_plan that compensates gravity.
+        """Return the reference of control of each node of the planning, indexed like x_plan.
 
         Args:
             x_plan (np.ndarray): Array of (q,v) for each node, describing the trajectory found by the planner.
             a_plan (np.ndarray): Array of (dv/dt) for each node, describing the trajectory found by the planner.
-            using_gravity (bool, optional): . Defaults to False.
+            using_gravity (bool, optional): Only compensate the gravity instead of using RNEA. Defaults to False.
 
         Returns:
             np.ndarray: Array of (u) for each node, found by either RNEA of Generalized Gravity.
         """
-        u_plan = np.zeros([x_plan.shape[0] - 1, self.nv])
-        if using_gravity:  ### TODO for Théo
-            pass
-            # for x in self.hpp_paths[path_idx].x_plan:
-            #     pin.computeGeneralizedGravity(
-            #         self._rmodel,
-            #         self.robot_data,
-            #         x[: self.nq],
-            #     )
-            #     u_plan.append(self.robot_data.g.copy())
+        u_table = np.zeros([x_plan.shape[0], self.nv])
+        if using_gravity:
+            for idx in range(x_plan.shape[0]):
+                u_table[idx, :] = pin.computeGeneralizedGravity(
+                    self._rmodel, self._rdata, x_plan[idx, : self.nq]
+                )
         else:
-            for idx in range(x_plan.shape[0] - 1):
-                x = x_plan[idx, :]
-                a = a_plan[idx, :]
-                tau = self.get_inverse_dynamic_control(x, a)
-                u_plan[idx, :] = tau[: self.nq]
-        return u_plan
+            for idx in range(x_plan.shape[0]):
+                u_table[idx, :] = self.get_inverse_dynamic_control(
+                    x_plan[idx, :], a_plan[idx, :]
+                )
+        return u_table
+
+    def get_u_plan(
+        self, x_plan: np.ndarray, a_plan: np.ndarray, using_gravity=False
+    ) -> np.ndarray:
+        """Return the reference of control u_plan that compensates gravity.
+
+        Args:
+            x_plan (np.ndarray): Array of (q,v) for each node, describing the trajectory found by the planner.
+            a_plan (np.ndarray): Array of (dv/dt) for each node, describing the trajectory found by the planner.
+            using_gravity (bool, optional): Only compensate the gravity instead of using RNEA. Defaults to False.
+
+        Returns:
+            np.ndarray: Array of (u) for each node but the last one, found by either RNEA of Generalized Gravity.
+        """
+        return self.get_u_ref_table(x_plan[:-1, :], a_plan[:-1, :], using_gravity)
 
     def set_weights(
         self,
@@ -128,25 +144,38 @@ class OCPCrocoHPP:
         self._weight_u_reg = weight_u_reg
         self._weight_vel_reg = weight_vel_reg
 
-    def set_models(self, x_plan: np.ndarray, a_plan: np.ndarray):
+    def get_placement_plan(self, x_plan: np.ndarray) -> np.ndarray:
+        """Return the (N, 4, 4) array of end effector placements along the state planning."""
+        return get_ee_placements_from_trajectory(
+            self._rmodel, self._rdata, self._last_joint_frame_id, x_plan[:, : self.nq]
+        )
+
+    def set_models(
+        self,
+        x_plan: np.ndarray,
+        a_plan: np.ndarray,
+        placement_plan: np.ndarray = None,
+        u_plan: np.ndarray = None,
+    ):
         """Set running models and terminal model for the ocp.
 
         Args:
             x_plan (np.ndarray): Array of (q,v) for each node, describing the trajectory found by the planner.
             a_plan (np.ndarray): Array of (dv/dt) for each node, describing the trajectory found by the planner.
+            placement_plan (np.ndarray, optional): Array of end effector placements for each node, computed from x_plan if not given.
+            u_plan (np.ndarray, optional): Array of (u) for each node but the last one, computed by RNEA if not given.
         """
         self.x_plan = x_plan
         self.a_plan = a_plan
         self.T = x_plan.shape[0]
-        self.u_plan = self.get_u_plan(x_plan, a_plan)
-        placement_ref = get_ee_pose_from_configuration(
-            self._rmodel,
-            self._rdata,
-            self._last_joint_frame_id,
-            self.x_plan[-1, : self.nq],
-        )
+        if u_plan is None:
+            u_plan = self.get_u_plan(x_plan, a_plan)
+        self.u_plan = u_plan
+        if placement_plan is None:
+            placement_plan = self.get_placement_plan(x_plan)
+        self.placement_plan = placement_plan
         self.set_running_models()
-        self.set_terminal_model(placement_ref)
+        self.set_terminal_model(pin.SE3(self.placement_plan[-1]))
 
     def set_running_models(self):
         """Set running models based on state and acceleration reference trajectory."""
@@ -158,9 +187,7 @@ class OCPCrocoHPP:
             x_reg_cost = self.get_state_residual(x_ref)
             u_reg_cost = self.get_control_residual(self.u_plan[idx, :])
             vel_reg_cost = self.get_velocity_residual(self._last_joint_name)
-            placement_ref = get_ee_pose_from_configuration(
-                self._rmodel, self._rdata, self._last_joint_frame_id, x_ref[: self.nq]
-            )
+            placement_ref = pin.SE3(self.placement_plan[idx])
             placement_reg_cost = self.get_placement_residual(placement_ref)
             running_cost_model.addCost("xReg", x_reg_cost, self._weight_x_reg)
             running_cost_model.addCost("uReg", u_reg_cost, self._weight_u_reg)
@@ -185,6 +212,14 @@ class OCPCrocoHPP:
         self.running_models = running_models
         return self.running_models
 
+    def get_simulation_model(self):
+        """Return a model integrating the robot dynamics over DT, without costs nor constraints."""
+        simulation_DAM = crocoddyl.DifferentialActionModelFreeFwdDynamics(
+            self.state, self.actuation, crocoddyl.CostModelSum(self.state)
+        )
+        simulation_DAM.armature = self.armature
+        return crocoddyl.IntegratedActionModelEuler(simulation_DAM, self.DT)
+
     def get_constraints(self):
         constraint_model_manager = crocoddyl.ConstraintModelManager(self.state, self.nq)
         if len(self._cmodel.collisionPairs) != 0:
@@ -220,10 +255,9 @@ class OCPCrocoHPP:
             "gripperPose", placement_reg_cost, self._weight_ee_placement
         )
         vel_cost = self.get_velocity_residual(self._last_joint_name)
-        if np.linalg.norm(x_ref[self.nq :]) < 1e-9:
-            terminal_cost_model.addCost("velReg", vel_cost, self._weight_ee_placement)
-        else:
-            terminal_cost_model.addCost("velReg", vel_cost, 0)
+        terminal_cost_model.addCost(
+            "velReg", vel_cost, self.get_terminal_vel_weight(x_ref)
+        )
         x_reg_cost = self.get_state_residual(x_ref)
         terminal_cost_model.addCost("xReg", x_reg_cost, 0)
 
@@ -245,10 +279,9 @@ class OCPCrocoHPP:
         u_reg_cost = self.get_control_residual(u_plan)
         vel_cost = self.get_velocity_residual(self._last_joint_name)
         terminal_cost_model.addCost("xReg", x_reg_cost, 0)
-        if np.linalg.norm(x_ref[self.nq :]) < 1e-9:
-            terminal_cost_model.addCost("velReg", vel_cost, self._weight_ee_placement)
-        else:
-            terminal_cost_model.addCost("velReg", vel_cost, 0)
+        terminal_cost_model.addCost(
+            "velReg", vel_cost, self.get_terminal_vel_weight(x_ref)
+        )
         terminal_cost_model.addCost(
             "gripperPose", placement_reg_cost, self._weight_ee_placement
         )
@@ -364,6 +397,25 @@ class OCPCrocoHPP:
             new_weight = new_model.differential.costs.costs[cost_name].weight
             model.differential.costs.costs[cost_name].weight = new_weight
 
+    def get_terminal_vel_weight(self, x_ref: np.ndarray):
+        """Return the weight of the terminal velocity cost, only active if the reference is at rest."""
+        if np.linalg.norm(x_ref[self.nq :]) < 1e-9:
+            return self._weight_ee_placement
+        return 0
+
+    def update_terminal_model(
+        self, model, placement_ref, x_ref: np.ndarray, u_plan: np.ndarray
+    ):
+        """Write new references and weights in the costs of the terminal model, without creating new crocoddyl objects."""
+        costs = model.differential.costs.costs
+        costs["gripperPose"].cost.residual.reference = placement_ref
+        costs["gripperPose"].weight = self._weight_ee_placement
+        costs["velReg"].weight = self.get_terminal_vel_weight(x_ref)
+        costs["xReg"].cost.residual.reference = x_ref
+        costs["xReg"].weight = 0
+        costs["uReg"].cost.residual.reference = u_plan
+        costs["uReg"].weight = 0
+
     def update_model(self, model, new_model, update_weight):
         """update model's costs by copying new_model's costs."""
         self.update_cost(model, new_model, "xReg", update_weight)
@@ -372,39 +424,35 @@ class OCPCrocoHPP:
         self.update_cost(model, new_model, "uReg", update_weight)
 
     def reset_ocp(self, x, x_ref: np.ndarray, u_plan: np.ndarray, placement_ref):
-        """Reset ocp problem using next reference in state and control."""
-        self.solver.problem.x0 = x
-        runningModels = list(self.solver.problem.runningModels)
-        for node_idx in range(len(runningModels) - 1):
-            self.update_model(
-                runningModels[node_idx], runningModels[node_idx + 1], False
-            )
-        self.update_model(runningModels[-1], self.solver.problem.terminalModel, False)
-        if self.use_constraints:
-            terminal_model = self.get_terminal_model_with_constraints(
-                placement_ref, x_ref, u_plan
-            )
-        else:
-            terminal_model = self.get_terminal_model_without_constraints(
-                placement_ref, x_ref, u_plan
-            )
-        self.update_model(self.solver.problem.terminalModel, terminal_model, True)
+        """Reset ocp problem using next reference in state and control.
 
-    def build_ocp_from_plannif(self, x_plan, a_plan, x0):
+        The horizon is used as a ring buffer: the first running node is moved
+        to the end of the problem with the references of the terminal node,
+        so only this node and the terminal one are updated.
+        """
+        problem = self.get_problem()
+        problem.x0 = x
+        first_model = problem.runningModels[0]
+        first_data = problem.runningDatas[0]
+        self.update_model(first_model, problem.terminalModel, False)
+        problem.circularAppend(first_model, first_data)
+        self.update_terminal_model(problem.terminalModel, placement_ref, x_ref, u_plan)
+
+    def build_ocp_from_plannif(
+        self, x_plan, a_plan, x0, placement_plan=None, u_plan=None
+    ):
         """Set models based on state and acceleration planning, create crocoddyl problem from it."""
-        self.set_models(x_plan, a_plan)
+        self.set_models(x_plan, a_plan, placement_plan, u_plan)
         return crocoddyl.ShootingProblem(x0, self.running_models, self.terminal_model)
 
-    def run_solver(self, problem, xs_init, us_init, max_iter, set_callback=False):
-        """
-        Run FDDP or CSQP solver
-        problem : crocoddyl ocp problem.
-        xs_init : xs warm start.
-        us_init : us warm start.
-        max_iter : max number of iteration for the solver
-        set_callback : activate solver callback
-        """
-        # Creating the solver for this OC problem, defining a logger
+    def get_problem(self):
+        """Return the crocoddyl problem currently solved by the solver."""
+        if self._solver_problem is not None:
+            return self._solver_problem
+        return self.solver.problem
+
+    def create_solver(self, problem):
+        """Create FDDP or CSQP solver for the crocoddyl problem."""
         if self.use_constraints:
             solver = mim_solvers.SolverCSQP(problem)
             solver.use_filter_line_search = True
@@ -414,7 +462,27 @@ class OCPCrocoHPP:
             solver = crocoddyl.SolverFDDP(problem)
             solver.use_filter_line_search = True
             solver.termination_tolerance = 1e-3
+        return solver
+
+    def run_solver(self, problem, xs_init, us_init, max_iter, set_callback=False):
+        """
+        Run FDDP or CSQP solver
+        problem : crocoddyl ocp problem.
+        xs_init : xs warm start.
+        us_init : us warm start.
+        max_iter : max number of iteration for the solver
+        set_callback : activate solver callback
+        """
+        # Creating the solver for this OC problem, defining a logger.
+        # In persistent mode the solver, and thus its workspace, is only
+        # created again when the problem changes.
+        if (
+            not self.persistent_solver
+            or self.solver is None
+            or self._solver_problem is not problem
+        ):
+            self.solver = self.create_solver(problem)
+            self._solver_problem = problem
         if set_callback:
-            solver.setCallbacks([crocoddyl.CallbackVerbose()])
-        solver.solve(xs_init, us_init, max_iter)
-        self.solver = solver
+            self.solver.setCallbacks([crocoddyl.CallbackVerbose()])
+        self.solver.solve(xs_init, us_init, max_iter)
@@ -1,56 +1,190 @@
 from __future__ import annotations
 import numpy as np
-from collections import deque
 
 from agimus_controller.trajectory_point import TrajectoryPoint, PointAttribute
 
 
 class TrajectoryBuffer:
-    """List of variable size in which the HPP trajectory nodes will be."""
+    """Buffer of variable size in which the HPP trajectory nodes will be.
 
-    def __init__(self):
-        self._buffer: deque[TrajectoryPoint] = deque()
-        print("type ", type(self._buffer))
+    The nodes are stored in contiguous preallocated arrays, the valid
+    attributes of each node being flagged in a bitmask, so that horizons can
+    be returned as views on these arrays.
+    """
+
+    def __init__(self, capacity: int = 256):
+        self._capacity = capacity
+        self._head = 0
+        self._tail = 0
+        # Index of the first invalid point for each mask of attributes.
+        self._first_invalid = {}
+        self.nq = None
+        self.nv = None
+
+    def _allocate(self, nq: int, nv: int):
+        self.nq = nq
+        self.nv = nv
+        self._time = np.zeros(self._capacity)
+        self._x = np.zeros([self._capacity, nq + nv])
+        self._a = np.zeros([self._capacity, nv])
+        self._tau = np.zeros([self._capacity, nv])
+        self._com_pos = np.zeros([self._capacity, 3])
+        self._com_vel = np.zeros([self._capacity, 3])
+        self._valid = np.zeros(self._capacity, dtype=np.uint8)
+
+    def _reserve(self, nb_points: int):
+        """Make room for nb_points after the tail of the buffer.
+
+        The remaining points are copied in new arrays, so that the views
+        previously returned stay untouched.
+        """
+        size = self._tail - self._head
+        if self._tail + nb_points <= self._capacity:
+            return
+        capacity = self._capacity
+        while size + nb_points > capacity // 2:
+            capacity *= 2
+        arrays = ["_time", "_x", "_a", "_tau", "_com_pos", "_com_vel", "_valid"]
+        for name in arrays:
+            old_array = getattr(self, name)
+            new_array = np.zeros((capacity,) + old_array.shape[1:], old_array.dtype)
+            new_array[:size] = old_array[self._head : self._tail]
+            setattr(self, name, new_array)
+        self._first_invalid = {
+            mask: max(idx - self._head, 0) for mask, idx in self._first_invalid.items()
+        }
+        self._capacity = capacity
+        self._head = 0
+        self._tail = size
 
     def add_trajectory_point(self, trajectory_point: TrajectoryPoint):
-        """Add trajectory point to the buffer if it matches the size of q and v"""
-        self._buffer.append(trajectory_point)
+        """Add trajectory point to the buffer."""
+        if self.nq is None:
+            self._allocate(len(trajectory_point.q), len(trajectory_point.v))
+        self._reserve(1)
+        idx = self._tail
+        self._time[idx] = trajectory_point.time
+        self._x[idx, : self.nq] = trajectory_point.q
+        self._x[idx, self.nq :] = trajectory_point.v
+        self._a[idx] = trajectory_point.a
+        self._tau[idx] = trajectory_point.tau
+        self._com_pos[idx] = trajectory_point.com_pos
+        self._com_vel[idx] = trajectory_point.com_vel
+        self._valid[idx] = trajectory_point.valid_mask
+        self._tail += 1
+
+    def add_trajectory_points(
+        self,
+        x: np.ndarray,
+        a: np.ndarray,
+        tau: np.ndarray = None,
+        time: np.ndarray = None,
+    ):
+        """Add the points of a chunk of states, accelerations and optionally torques in one copy.
+
+        Args:
+            x (np.ndarray): (N, nq + nv) array of states of the points.
+            a (np.ndarray): (N, nv) array of accelerations of the points.
+            tau (np.ndarray, optional): (N, nv) array of torques of the points. Defaults to None.
+            time (np.ndarray, optional): (N,) array of times of the points. Defaults to None.
+        """
+        nb_points = x.shape[0]
+        if self.nq is None:
+            self._allocate(x.shape[1] - a.shape[1], a.shape[1])
+        self._reserve(nb_points)
+        chunk = slice(self._tail, self._tail + nb_points)
+        valid = self._get_mask([PointAttribute.Q, PointAttribute.V, PointAttribute.A])
+        self._x[chunk] = x
+        self._a[chunk] = a
+        if tau is not None:
+            self._tau[chunk] = tau
+            valid |= self._get_mask([PointAttribute.TAU])
+        self._time[chunk] = 0 if time is None else time
+        self._valid[chunk] = valid
+        self._tail += nb_points
+
+    @staticmethod
+    def _get_mask(attributes: list[PointAttribute]) -> int:
+        mask = 0
+        for attribute in attributes:
+            mask |= 1 << attribute.value
+        return mask
 
     def get_size(self, attributes: list[PointAttribute]):
-        """Returns the size of the buffer until the first invalid TrajectoryPoint"""
-        for idx, point in enumerate(self._buffer):
-            for attribute in attributes:
-                if not point.attribute_is_valid(attribute):
-                    print(
-                        f"buffer point at index {idx} is not valid for attribute {attribute}"
-                    )
-                    return idx
-        return len(self._buffer)
+        """Returns the size of the buffer until the first invalid TrajectoryPoint.
 
-    def get_points(self, nb_points: int, attributes: list[PointAttribute]):
-        """Get nb_points of valid TrajectoryPoints from the buffer"""
+        Points are never modified once added, so only the points added since
+        the last call are checked.
+        """
+        if self.nq is None:
+            return 0
+        mask = self._get_mask(attributes)
+        idx = max(self._first_invalid.get(mask, self._head), self._head)
+        while idx < self._tail and (self._valid[idx] & mask) == mask:
+            idx += 1
+        self._first_invalid[mask] = idx
+        if idx < self._tail:
+            print(
+                f"buffer point at index {idx - self._head} is not valid "
+                f"for attributes {attributes}"
+            )
+        return idx - self._head
+
+    def front_is_valid(
+        self, attributes: list[PointAttribute], nb_points: int = 1
+    ) -> bool:
+        """Returns True if the first nb_points points of the buffer are valid for all the attributes."""
+        if self._tail - self._head < nb_points:
+            return False
+        mask = self._get_mask(attributes)
+        valid = self._valid[self._head : self._head + nb_points] & mask
+        return bool(np.all(valid == mask))
+
+    def _check_size(self, nb_points: int, attributes: list[PointAttribute]):
         buffer_size = self.get_size(attributes)
         if nb_points > buffer_size:
             raise Exception(
-                "the buffer size is {buffer_size} and you ask for {nb_points}"
+                f"the buffer size is {buffer_size} and you ask for {nb_points}"
             )
-        else:
-            return [self._buffer.popleft() for _ in range(nb_points)]
+
+    def _get_point(self, idx: int) -> TrajectoryPoint:
+        point = TrajectoryPoint(time=self._time[idx], nq=self.nq, nv=self.nv)
+        values = [
+            self._x[idx, : self.nq],
+            self._x[idx, self.nq :],
+            self._a[idx],
+            self._tau[idx],
+            self._com_pos[idx],
+            self._com_vel[idx],
+        ]
+        for attribute, value in zip(PointAttribute, values):
+            if self._valid[idx] & (1 << attribute.value):
+                setattr(point, attribute.name.lower(), value.copy())
+        return point
+
+    def get_points(self, nb_points: int, attributes: list[PointAttribute]):
+        """Get nb_points of valid TrajectoryPoints from the buffer"""
+        self._check_size(nb_points, attributes)
+        points = [
+            self._get_point(idx) for idx in range(self._head, self._head + nb_points)
+        ]
+        self._head += nb_points
+        return points
+
+    def get_horizon(self, nb_points: int, attributes: list[PointAttribute]):
+        """Pop nb_points valid points from the buffer and return views of their states, accelerations and torques."""
+        self._check_size(nb_points, attributes)
+        horizon = slice(self._head, self._head + nb_points)
+        self._head += nb_points
+        return self._x[horizon], self._a[horizon], self._tau[horizon]
 
     def get_state_horizon_planning(self):
         """Return the state planning for the horizon, state is composed of joints positions and velocities"""
-        nx = len(self._buffer[0].q) + len(self._buffer[0].v)
-        x_plan = np.zeros([len(self._buffer), nx])
-        for idx, point in enumerate(self._buffer):
-            x_plan[idx, :] = np.concatenate([point.q, point.v])
-        return x_plan
+        return self._x[self._head : self._tail]
 
     def get_joint_acceleration_horizon(self):
         """Return the acceleration reference for the horizon, state is composed of joints positions and velocities"""
-        a_plan = np.zeros([len(self._buffer), self.nv])
-        for idx, point in enumerate(self._buffer):
-            a_plan[idx, :] = point.a
-        return a_plan
+        return self._a[self._head : self._tail]
 
     def get_buffer(self):
-        return self._buffer.copy()
+        return [self._get_point(idx) for idx in range(self._head, self._tail)]
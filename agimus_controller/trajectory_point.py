@@ -13,35 +13,90 @@ class PointAttribute(Enum):
 
 
 class TrajectoryPoint:
+    """Point of a trajectory, an attribute is valid once it has been assigned.
+
+    The validity of the attributes is tracked in a bitmask set by the
+    attribute setters, writing in place in an attribute array does not
+    make it valid.
+    """
+
     def __init__(self, time=0, nq=0, nv=0):
-        self.q = np.zeros(nq) * np.nan
-        self.v = np.zeros(nv) * np.nan
-        self.a = np.zeros(nv) * np.nan
-        self.tau = np.zeros(nv) * np.nan
-        self.com_pos = np.zeros(3) * np.nan
-        self.com_vel = np.zeros(3) * np.nan
+        self.valid_mask = 0
+        self._q = np.zeros(nq) * np.nan
+        self._v = np.zeros(nv) * np.nan
+        self._a = np.zeros(nv) * np.nan
+        self._tau = np.zeros(nv) * np.nan
+        self._com_pos = np.zeros(3) * np.nan
+        self._com_vel = np.zeros(3) * np.nan
         self.op_pos = {}
         self.op_vel = {}
         self.nq = nq
         self.nv = nv
         self.time = time
-        self.attribute_validation_dict = self.get_attribute_validation_dict()
-
-    def get_attribute_validation_dict(self):
-        attribute_validation_dict = {}
-        attribute_validation_dict[PointAttribute.Q] = self.q_is_valid
-        attribute_validation_dict[PointAttribute.V] = self.v_is_valid
-        attribute_validation_dict[PointAttribute.A] = self.a_is_valid
-        attribute_validation_dict[PointAttribute.TAU] = self.tau_is_valid
-        attribute_validation_dict[PointAttribute.COM_POS] = self.com_pos_is_valid
-        attribute_validation_dict[PointAttribute.COM_VEL] = self.com_vel_is_valid
-        return attribute_validation_dict
+
+    def _set_attribute(self, attribute: PointAttribute, name: str, value):
+        setattr(self, name, np.asarray(value, dtype=float))
+        self.valid_mask |= 1 << attribute.value
+
+    @property
+    def q(self) -> np.ndarray:
+        return self._q
+
+    @q.setter
+    def q(self, value):
+        self._set_attribute(PointAttribute.Q, "_q", value)
+
+    @property
+    def v(self) -> np.ndarray:
+        return self._v
+
+    @v.setter
+    def v(self, value):
+        self._set_attribute(PointAttribute.V, "_v", value)
+
+    @property
+    def a(self) -> np.ndarray:
+        return self._a
+
+    @a.setter
+    def a(self, value):
+        self._set_attribute(PointAttribute.A, "_a", value)
+
+    @property
+    def tau(self) -> np.ndarray:
+        return self._tau
+
+    @tau.setter
+    def tau(self, value):
+        self._set_attribute(PointAttribute.TAU, "_tau", value)
+
+    @property
+    def com_pos(self) -> np.ndarray:
+        return self._com_pos
+
+    @com_pos.setter
+    def com_pos(self, value):
+        self._set_attribute(PointAttribute.COM_POS, "_com_pos", value)
+
+    @property
+    def com_vel(self) -> np.ndarray:
+        return self._com_vel
+
+    @com_vel.setter
+    def com_vel(self, value):
+        self._set_attribute(PointAttribute.COM_VEL, "_com_vel", value)
 
     def resize(self, nq, nv):
-        self.q = np.zeros(nq) * np.nan
-        self.v = np.zeros(nv) * np.nan
-        self.a = np.zeros(nv) * np.nan
-        self.tau = np.zeros(nv) * np.nan
+        self._q = np.zeros(nq) * np.nan
+        self._v = np.zeros(nv) * np.nan
+        self._a = np.zeros(nv) * np.nan
+        self._tau = np.zeros(nv) * np.nan
+        self.valid_mask &= ~(
+            (1 << PointAttribute.Q.value)
+            | (1 << PointAttribute.V.value)
+            | (1 << PointAttribute.A.value)
+            | (1 << PointAttribute.TAU.value)
+        )
         self.nq = nq
         self.nv = nv
 
@@ -49,22 +104,50 @@ class TrajectoryPoint:
         return np.concatenate([self.q, self.v])
 
     def attribute_is_valid(self, attribute: PointAttribute):
-        return self.attribute_validation_dict[attribute]()
+        return bool(self.valid_mask & (1 << attribute.value))
 
     def q_is_valid(self):
-        return not np.array_equal(self.q, np.zeros(self.nq) * np.nan)
+        return self.attribute_is_valid(PointAttribute.Q)
 
     def v_is_valid(self):
-        return not np.array_equal(self.v, np.zeros(self.nv) * np.nan)
+        return self.attribute_is_valid(PointAttribute.V)
 
     def a_is_valid(self):
-        return not np.array_equal(self.a, np.zeros(self.nv) * np.nan)
+        return self.attribute_is_valid(PointAttribute.A)
 
     def tau_is_valid(self):
-        return not np.array_equal(self.tau, np.zeros(self.nv) * np.nan)
+        return self.attribute_is_valid(PointAttribute.TAU)
 
     def com_pos_is_valid(self):
-        return not np.array_equal(self.com_pos, np.zeros(3) * np.nan)
+        return self.attribute_is_valid(PointAttribute.COM_POS)
 
     def com_vel_is_valid(self):
-        return not np.array_equal(self.com_vel, np.zeros(3) * np.nan)
+        return self.attribute_is_valid(PointAttribute.COM_VEL)
+
+
+class TrajectoryPointView(TrajectoryPoint):
+    """Trajectory point whose q, v and a are views on rows of state and acceleration plannings.
+
+    No data is copied: writing in place in q, v or a modifies the
+    plannings. The attributes that are not given are read-only NaN arrays
+    until they are assigned.
+    """
+
+    def __init__(self, time, x: np.ndarray, a: np.ndarray, nq: int):
+        nv = x.shape[0] - nq
+        self.valid_mask = (
+            (1 << PointAttribute.Q.value)
+            | (1 << PointAttribute.V.value)
+            | (1 << PointAttribute.A.value)
+        )
+        self._q = x[:nq]
+        self._v = x[nq:]
+        self._a = a
+        self._tau = np.broadcast_to(np.nan, (nv,))
+        self._com_pos = np.broadcast_to(np.nan, (3,))
+        self._com_vel = np.broadcast_to(np.nan, (3,))
+        self.op_pos = {}
+        self.op_vel = {}
+        self.nq = nq
+        self.nv = nv
+        self.time = time
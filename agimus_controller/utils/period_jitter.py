@@ -0,0 +1,32 @@
+from collections import deque
+
+import numpy as np
+
+
+class PeriodJitter:
+    """Deviations of the periods of a loop from its nominal period, over the last ticks.
+
+    tick is called once per iteration of the loop, with the start time of
+    the iteration.
+    """
+
+    def __init__(self, period: float, window: int = 1000) -> None:
+        self.period = period
+        self._deviations = deque(maxlen=window)
+        self._last_time = None
+
+    def tick(self, current_time: float):
+        if self._last_time is not None:
+            self._deviations.append(current_time - self._last_time - self.period)
+        self._last_time = current_time
+
+    def get_statistics(self) -> dict:
+        """Return the mean, standard deviation and maximum absolute value of the period deviations, in seconds."""
+        if len(self._deviations) == 0:
+            return {"mean": 0.0, "std": 0.0, "max": 0.0}
+        deviations = np.array(self._deviations)
+        return {
+            "mean": np.mean(deviations),
+            "std": np.std(deviations),
+            "max": np.max(np.abs(deviations)),
+        }
@@ -21,6 +21,102 @@ def rotate(se3_placement, rpy=[0.0, 0.0, 0.0]):
     return se3_placement_rotated
 
 
+def get_frames_kinematics(
+    model: pin.Model,
+    q_traj: np.ndarray,
+    frame_ids,
+    dq_traj: np.ndarray = None,
+    ref=pin.LOCAL,
+    data: pin.Data = None,
+    compute_rotations: bool = True,
+    compute_rpy: bool = True,
+):
+    """Returns the positions, rotations, RPY angles and velocities of frames along a trajectory.
+
+    A single forward kinematics pass is done for each sample, the placements
+    and velocities of all the frames being read from it. The outputs that
+    are not needed can be disabled, the RPY conversion being the most costly.
+
+    Args:
+        model (pin.Model): Pinocchio Model of the robot.
+        q_traj (np.ndarray): (N, nq) array of configurations of the robot.
+        frame_ids (list): IDs of the F frames.
+        dq_traj (np.ndarray, optional): (N, nv) array of velocities of the robot, the velocities of the frames are not computed if None. Defaults to None.
+        ref (pin.ReferenceFrame, optional): Reference frame of the velocities. Defaults to pin.LOCAL.
+        data (pin.Data, optional): Pinocchio data of the robot, reused for all the samples, created if None. Defaults to None.
+        compute_rotations (bool, optional): Compute the rotations. Defaults to True.
+        compute_rpy (bool, optional): Compute the RPY angles. Defaults to True.
+
+    Returns:
+        Tuple[np.ndarray]: (F, N, 3) positions, (F, N, 3, 3) rotations, (F, N, 3) RPY angles, (F, N, 3) linear and angular velocities, the outputs not computed being None.
+    """
+    if data is None:
+        data = model.createData()
+    N = np.shape(q_traj)[0]
+    F = len(frame_ids)
+    p = np.empty((F, N, 3))
+    R = np.empty((F, N, 3, 3)) if compute_rotations else None
+    rpy = np.empty((F, N, 3)) if compute_rpy else None
+    v = None
+    w = None
+    if dq_traj is not None:
+        v = np.empty((F, N, 3))
+        w = np.empty((F, N, 3))
+    for i in range(N):
+        if dq_traj is None:
+            pin.forwardKinematics(model, data, q_traj[i])
+        else:
+            pin.forwardKinematics(model, data, q_traj[i], dq_traj[i])
+        for f, frame_id in enumerate(frame_ids):
+            placement = pin.updateFramePlacement(model, data, frame_id)
+            p[f, i] = placement.translation
+            if compute_rotations:
+                R[f, i] = placement.rotation
+            if compute_rpy:
+                rpy[f, i] = pin.rpy.matrixToRpy(placement.rotation)  # %(2*np.pi)
+            if dq_traj is not None:
+                spatial_vel = pin.getFrameVelocity(model, data, frame_id, ref)
+                v[f, i] = spatial_vel.linear
+                w[f, i] = spatial_vel.angular
+    return p, R, rpy, v, w
+
+
+def _is_single_configuration(q):
+    return type(q) is np.ndarray and len(q.shape) == 1
+
+
+def _get_frame_kinematics(
+    q,
+    model,
+    id_endeff,
+    dq=None,
+    ref=pin.LOCAL,
+    compute_rotations=False,
+    compute_rpy=False,
+):
+    """Returns the kinematics of a single frame, for a configuration or a trajectory, see get_frames_kinematics."""
+    if dq is not None and len(q) != len(dq):
+        print("q and dq must have the same size !")
+    single = _is_single_configuration(q)
+    q_traj = [q] if single else q
+    dq_traj = None
+    if dq is not None:
+        dq_traj = [dq] if single else dq
+    kinematics = get_frames_kinematics(
+        model,
+        q_traj,
+        [id_endeff],
+        dq_traj,
+        ref,
+        compute_rotations=compute_rotations,
+        compute_rpy=compute_rpy,
+    )
+    return [
+        None if array is None else (array[0, 0] if single else array[0])
+        for array in kinematics
+    ]
+
+
 # Get frame position
 def get_p(q, pin_robot, id_endeff):
     """
@@ -39,20 +135,7 @@ def get_p_(q, model, id_endeff):
         model     : pinocchio model
         id_endeff : id of EE frame
     """
-
-    data = model.createData()
-    if type(q) is np.ndarray and len(q.shape) == 1:
-        pin.forwardKinematics(model, data, q)
-        pin.updateFramePlacements(model, data)
-        p = data.oMf[id_endeff].translation.T
-    else:
-        N = np.shape(q)[0]
-        p = np.empty((N, 3))
-        for i in range(N):
-            pin.forwardKinematics(model, data, q[i])
-            pin.updateFramePlacements(model, data)
-            p[i, :] = data.oMf[id_endeff].translation.T
-    return p
+    return _get_frame_kinematics(q, model, id_endeff)[0]
 
 
 # Get frame linear velocity
@@ -75,25 +158,7 @@ def get_v_(q, dq, model, id_endeff, ref=pin.LOCAL):
         model     : pinocchio model
         id_endeff : id of EE frame
     """
-    data = model.createData()
-    if len(q) != len(dq):
-        print("q and dq must have the same size !")
-    if type(q) is np.ndarray and len(q.shape) == 1:
-        # J = pin.computeFrameJacobian(model, data, q, id_endeff)
-        # v = J.dot(dq)[:3]
-        pin.forwardKinematics(model, data, q, dq)
-        spatial_vel = pin.getFrameVelocity(model, data, id_endeff, ref)
-        v = spatial_vel.linear
-    else:
-        N = np.shape(q)[0]
-        v = np.empty((N, 3))
-        for i in range(N):
-            # J = pin.computeFrameJacobian(model, data, q[i,:], id_endeff)
-            # v[i,:] = J.dot(dq[i])[:3]
-            pin.forwardKinematics(model, data, q[i], dq[i])
-            spatial_vel = pin.getFrameVelocity(model, data, id_endeff, ref)
-            v[i, :] = spatial_vel.linear
-    return v
+    return _get_frame_kinematics(q, model, id_endeff, dq, ref)[3]
 
 
 # Get frame orientation (rotation)
@@ -115,17 +180,10 @@ def get_R_(q, model, id_endeff):
         id_endeff : id of EE frame
     Output : single 3x3 array (or list of 3x3 arrays)
     """
-    data = model.createData()
-    if type(q) is np.ndarray and len(q.shape) == 1:
-        pin.framesForwardKinematics(model, data, q)
-        R = data.oMf[id_endeff].rotation.copy()
-    else:
-        N = np.shape(q)[0]
-        R = []
-        for i in range(N):
-            pin.framesForwardKinematics(model, data, q[i])
-            R.append(data.oMf[id_endeff].rotation.copy())
-    return R
+    R = _get_frame_kinematics(q, model, id_endeff, compute_rotations=True)[1]
+    if _is_single_configuration(q):
+        return R
+    return list(R)
 
 
 # Get frame orientation (RPY)
@@ -146,15 +204,7 @@ def get_rpy_(q, model, id_endeff):
         model     : pinocchio model
         id_endeff : id of EE frame
     """
-    R = get_R_(q, model, id_endeff)
-    if isinstance(R, list):
-        N = np.shape(q)[0]
-        rpy = np.empty((N, 3))
-        for i in range(N):
-            rpy[i, :] = pin.rpy.matrixToRpy(R[i])  # %(2*np.pi)
-    else:
-        rpy = pin.rpy.matrixToRpy(R)  # %(2*np.pi)
-    return rpy
+    return _get_frame_kinematics(q, model, id_endeff, compute_rpy=True)[2]
 
 
 # Get frame angular velocity
@@ -177,21 +227,7 @@ def get_w_(q, dq, model, id_endeff, ref=pin.LOCAL):
         pin_robot : pinocchio wrapper
         id_endeff : id of EE frame
     """
-    data = model.createData()
-    if len(q) != len(dq):
-        print("q and dq must have the same size !")
-    if type(q) is np.ndarray and len(q.shape) == 1:
-        pin.forwardKinematics(model, data, q, dq)
-        spatial_vel = pin.getFrameVelocity(model, data, id_endeff, ref)
-        w = spatial_vel.angular
-    else:
-        N = np.shape(q)[0]
-        w = np.empty((N, 3))
-        for i in range(N):
-            pin.forwardKinematics(model, data, q[i], dq[i])
-            spatial_vel = pin.getFrameVelocity(model, data, id_endeff, ref)
-            w[i, :] = spatial_vel.angular
-    return w
+    return _get_frame_kinematics(q, model, id_endeff, dq, ref)[4]
 
 
 # Get gravity joint torque
@@ -257,6 +293,32 @@ def get_ee_pose_from_configuration(
     return pose
 
 
+def get_ee_placements_from_trajectory(
+    rmodel: pin.Model, rdata: pin.Data, id_ee_frame_id: int, q_traj: np.ndarray
+) -> np.ndarray:
+    """Returns the placements of the end effector of the robot along a trajectory.
+
+    Only the placement of the end effector frame is updated after the forward kinematics of each configuration.
+
+    Args:
+        rmodel (pin.Model): Pinocchio Model of the robot.
+        rdata (pin.Data): Pinocchio data of the robot
+        id_ee_frame_id (int): ID of the frame of the end effector.
+        q_traj (np.ndarray): (N, nq) array of configurations of the robot.
+
+    Returns:
+        np.ndarray: (N, 4, 4) array of the homogeneous matrices of the end effector placements.
+    """
+    p, R, _, _, _ = get_frames_kinematics(
+        rmodel, q_traj, [id_ee_frame_id], data=rdata, compute_rpy=False
+    )
+    placements = np.zeros((q_traj.shape[0], 4, 4))
+    placements[:, :3, :3] = R[0]
+    placements[:, :3, 3] = p[0]
+    placements[:, 3, 3] = 1.0
+    return placements
+
+
 def get_last_joint(rmodel) -> Tuple[str, int, int]:
     """Returns the name of the last joint and it's id, with regards to the robot's type.
 
@@ -0,0 +1,56 @@
+import multiprocessing
+
+
+class SolverProcess:
+    """Run a solve function in a child process, outside of the GIL of the caller.
+
+    The crocoddyl and mim_solvers solvers hold the GIL during a solve, so a
+    solve run in a thread blocks all the other threads of the process. The
+    child process is forked when the object is created: the solve function
+    and the objects it uses, such as an ocp already solved once, are
+    inherited in their current state without being pickled. Since the
+    other threads of the caller are not forked, the solve function must not
+    use them, nor ROS.
+
+    The arguments and the results of each solve are sent through a pipe,
+    the caller waiting for the result with the GIL released.
+    """
+
+    def __init__(self, solve_function) -> None:
+        context = multiprocessing.get_context("fork")
+        self._conn, child_conn = context.Pipe()
+        self._process = context.Process(
+            target=self._run,
+            args=(solve_function, child_conn, self._conn),
+            daemon=True,
+        )
+        self._process.start()
+        child_conn.close()
+
+    @staticmethod
+    def _run(solve_function, conn, parent_conn):
+        # Close the copy of the parent end of the pipe, for recv to raise
+        # EOFError once the parent closed it.
+        parent_conn.close()
+        while True:
+            try:
+                args = conn.recv()
+            except EOFError:
+                return
+            try:
+                conn.send((True, solve_function(*args)))
+            except Exception as exception:
+                conn.send((False, exception))
+
+    def solve(self, *args):
+        """Run the solve function on args in the child process and return its result."""
+        self._conn.send(args)
+        succeeded, result = self._conn.recv()
+        if not succeeded:
+            raise result
+        return result
+
+    def close(self):
+        """Stop the child process."""
+        self._conn.close()
+        self._process.join()
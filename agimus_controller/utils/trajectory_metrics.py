@@ -0,0 +1,117 @@
+from typing import Tuple
+
+import numpy as np
+import pinocchio as pin
+
+from agimus_controller.utils.pin_utils import get_frames_kinematics
+
+
+def get_tracking_error(xs: np.ndarray, x_plan: np.ndarray, nq: int) -> float:
+    """Returns the sum over the nodes of xs of the absolute configuration differences with x_plan.
+
+    Args:
+        xs (np.ndarray): (N, nx) array of the simulated states.
+        x_plan (np.ndarray): (M, nx) array of the planned states, with M >= N.
+        nq (int): Dimension of the configuration of the robot.
+    """
+    return np.sum(np.abs(xs[:, :nq] - x_plan[: xs.shape[0], :nq]))
+
+
+def get_max_torque(us: np.ndarray) -> float:
+    """Returns the maximum absolute torque of a control trajectory."""
+    return np.max(np.abs(us))
+
+
+def get_max_torque_increment(us: np.ndarray) -> Tuple[float, Tuple[int, int]]:
+    """Returns the maximum absolute torque increment between two nodes and its (node, joint) index."""
+    if us.shape[0] < 2:
+        return 0.0, (0, 0)
+    increases = np.abs(np.diff(us, axis=0))
+    return np.max(increases), np.unravel_index(np.argmax(increases), increases.shape)
+
+
+def get_max_jerk(xs: np.ndarray, nq: int, dt: float) -> float:
+    """Returns the maximum absolute joint jerk, computed by finite differences of the velocities of xs.
+
+    Args:
+        xs (np.ndarray): (N, nx) array of the states.
+        nq (int): Dimension of the configuration of the robot.
+        dt (float): Time step between two nodes.
+    """
+    if xs.shape[0] < 3:
+        return 0.0
+    return np.max(np.abs(np.diff(xs[:, nq:], n=2, axis=0))) / dt**2
+
+
+def get_ee_translations(
+    rmodel: pin.Model, rdata: pin.Data, id_ee_frame_id: int, q_traj: np.ndarray
+) -> np.ndarray:
+    """Returns the (N, 3) array of the end effector translations along a configuration trajectory."""
+    p, _, _, _, _ = get_frames_kinematics(
+        rmodel,
+        q_traj,
+        [id_ee_frame_id],
+        data=rdata,
+        compute_rotations=False,
+        compute_rpy=False,
+    )
+    return p[0]
+
+
+def get_ee_deviation(
+    ee_translations: np.ndarray, ee_translations_ref: np.ndarray
+) -> float:
+    """Returns the sum over the nodes of ee_translations of the absolute differences with ee_translations_ref."""
+    nb_nodes = ee_translations.shape[0]
+    return np.sum(np.abs(ee_translations - ee_translations_ref[:nb_nodes]))
+
+
+def get_trajectory_metrics(
+    xs: np.ndarray,
+    us: np.ndarray,
+    x_plan: np.ndarray,
+    nq: int,
+    dt: float,
+    rmodel: pin.Model = None,
+    rdata: pin.Data = None,
+    id_ee_frame_id: int = None,
+    ee_translations_ref: np.ndarray = None,
+) -> dict:
+    """Returns the metrics of a simulated run compared to its planning.
+
+    The end effector deviation is only computed if the robot model is
+    given, with a single forward kinematics pass on the simulated
+    configurations. The end effector translations of the planning, which
+    do not change between runs, can be given in ee_translations_ref to not
+    compute them again.
+
+    Args:
+        xs (np.ndarray): (N, nx) array of the simulated states.
+        us (np.ndarray): (N - 1, nv) array of the simulated controls.
+        x_plan (np.ndarray): (M, nx) array of the planned states, with M >= N.
+        nq (int): Dimension of the configuration of the robot.
+        dt (float): Time step between two nodes.
+        rmodel (pin.Model, optional): Pinocchio Model of the robot. Defaults to None.
+        rdata (pin.Data, optional): Pinocchio data of the robot. Defaults to None.
+        id_ee_frame_id (int, optional): ID of the frame of the end effector. Defaults to None.
+        ee_translations_ref (np.ndarray, optional): (M, 3) array of the end effector translations of the planning. Defaults to None.
+
+    Returns:
+        dict: tracking_error, max_torque, max_torque_increment, max_jerk and, if the model is given, ee_deviation.
+    """
+    metrics = {
+        "tracking_error": get_tracking_error(xs, x_plan, nq),
+        "max_torque": get_max_torque(us),
+        "max_torque_increment": get_max_torque_increment(us)[0],
+        "max_jerk": get_max_jerk(xs, nq, dt),
+    }
+    if rmodel is not None:
+        if ee_translations_ref is None:
+            ee_translations_ref = get_ee_translations(
+                rmodel, rdata, id_ee_frame_id, x_plan[: xs.shape[0], :nq]
+            )
+        metrics["ee_deviation"] = get_ee_deviation(
+            get_ee_translations(rmodel, rdata, id_ee_frame_id, xs[:, :nq]),
+            ee_translations_ref,
+        )
+    return metrics
@@ -10,3 +10,20 @@ class AgimusControllerNode(ControllerBase):
 
     def get_next_trajectory_point(self):
         return self.hpp_subscriber.get_trajectory_point()
+
+    def fill_buffer(self):
+        if not self.hpp_subscriber.params.use_chunks:
+            super().fill_buffer()
+            return
+        # Once the controller runs, only wait for a chunk when the buffer is
+        # empty, then add all the chunks already received.
+        blocking = (
+            self.mpc is None or self.traj_buffer.get_size(self.point_attributes) == 0
+        )
+        chunk = self.hpp_subscriber.get_trajectory_chunk(blocking)
+        while chunk is not None:
+            times, stacked_x_a = chunk
+            self.traj_buffer.add_trajectory_points(
+                stacked_x_a[:, : self.nx], stacked_x_a[:, self.nx :], time=times
+            )
+            chunk = self.hpp_subscriber.get_trajectory_chunk(blocking=False)
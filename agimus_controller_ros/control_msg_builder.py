@@ -0,0 +1,25 @@
+import rospy
+import numpy as np
+from linear_feedback_controller_msgs.msg import Control
+
+from agimus_controller.utils.ros_np_multiarray import to_multiarray_f64
+
+
+class ControlMsgBuilder:
+    """Build the Control messages sent to the robot.
+
+    The same message, with its header and multiarray layouts, is reused at
+    each call, only the numeric data and the timestamp are overwritten.
+    """
+
+    def __init__(self, nu: int, nx: int) -> None:
+        self.control_msg = Control()
+        self.control_msg.feedback_gain = to_multiarray_f64(np.zeros([nu, nx]))
+        self.control_msg.feedforward = to_multiarray_f64(np.zeros(nu))
+
+    def build(self, sensor_msg, u: np.ndarray, k: np.ndarray) -> Control:
+        self.control_msg.header.stamp = rospy.Time.now()
+        self.control_msg.feedback_gain.data = k.ravel().tolist()
+        self.control_msg.feedforward.data = u.ravel().tolist()
+        self.control_msg.initial_state = sensor_msg
+        return self.control_msg
@@ -1,14 +1,12 @@
 #!/usr/bin/env python3
 import rospy
 import numpy as np
-from copy import deepcopy
 import time
-from threading import Lock
-from std_msgs.msg import Duration, Header
+from threading import Thread
+from std_msgs.msg import Duration
 from linear_feedback_controller_msgs.msg import Control, Sensor
 import atexit
 
-from agimus_controller.utils.ros_np_multiarray import to_multiarray_f64
 from agimus_controller.trajectory_buffer import TrajectoryBuffer
 from agimus_controller.trajectory_point import PointAttribute
 from agimus_controller.utils.build_models import RobotModelConstructor
@@ -18,6 +16,10 @@ from agimus_controller.utils.pin_utils import (
 )
 from agimus_controller.mpc import MPC
 from agimus_controller.ocps.ocp_croco_hpp import OCPCrocoHPP
+from agimus_controller.utils.period_jitter import PeriodJitter
+from agimus_controller.utils.solver_process import SolverProcess
+from agimus_controller_ros.control_msg_builder import ControlMsgBuilder
+from agimus_controller_ros.sensor_state_slot import SensorStateSlot
 from agimus_controller_ros.sim_utils import convert_float_to_ros_duration_msg
 
 
@@ -25,6 +27,8 @@ class AgimusControllerNodeParameters:
     def __init__(self) -> None:
         self.rate = rospy.get_param("~rate", 100)
         self.horizon_size = rospy.get_param("~horizon_size", 100)
+        self.use_solver_process = rospy.get_param("~use_solver_process", False)
+        self.publish_rate = rospy.get_param("~publish_rate", self.rate)
 
 
 class ControllerBase:
@@ -49,17 +53,24 @@ class ControllerBase:
         self.armature = np.array([0.05] * self.nq)
 
         self.ocp = OCPCrocoHPP(
-            self.rmodel, self.cmodel, use_constraints=False, armature=self.armature
+            self.rmodel,
+            self.cmodel,
+            use_constraints=False,
+            armature=self.armature,
+            persistent_solver=True,
         )
         self.ocp.set_weights(10**4, 10, 10**-3, 0)
         self.save_predictions_and_refs = False
-        self.mpc_data = {}
+        self.mpc = None
+        self.mpc_recorder = None
+        self.solution = None
+        self.solver_process = None
 
         self.rate = rospy.Rate(self.params.rate, reset=True)
-        self.mutex = Lock()
-        self.sensor_msg = Sensor()
-        self.control_msg = Control()
+        self.sensor_state = SensorStateSlot(self.nq, self.nv)
+        self.control_msg_builder = ControlMsgBuilder(self.nv, self.nx)
         self.ocp_solve_time = Duration()
+        self.send_time = Duration()
         self.x0 = np.zeros(self.nq + self.nv)
         self.x_guess = np.zeros(self.nq + self.nv)
         self.u_guess = np.zeros(self.nv)
@@ -74,15 +85,17 @@ class ControllerBase:
         self.ocp_solve_time_pub = rospy.Publisher(
             "ocp_solve_time", Duration, queue_size=1, tcp_nodelay=True
         )
+        self.send_time_pub = rospy.Publisher(
+            "control_send_time", Duration, queue_size=1, tcp_nodelay=True
+        )
         self.start_time = 0.0
         self.first_robot_sensor_msg_received = False
         self.first_pose_ref_msg_received = True
 
     def sensor_callback(self, sensor_msg):
-        with self.mutex:
-            self.sensor_msg = deepcopy(sensor_msg)
-            if not self.first_robot_sensor_msg_received:
-                self.first_robot_sensor_msg_received = True
+        self.sensor_state.write(sensor_msg)
+        if not self.first_robot_sensor_msg_received:
+            self.first_robot_sensor_msg_received = True
 
     def wait_first_sensor_msg(self):
         wait_for_input = True
@@ -93,9 +106,8 @@ class ControllerBase:
             )
             if wait_for_input:
                 rospy.loginfo_throttle(3, "Waiting until we receive a sensor message.")
-                with self.mutex:
-                    sensor_msg = deepcopy(self.sensor_msg)
-                    self.start_time = sensor_msg.header.stamp.to_sec()
+                stamp, _ = self.sensor_state.read(self.x0)
+                self.start_time = stamp.to_sec()
             rospy.loginfo_once("Start controller")
             self.rate.sleep()
         return wait_for_input
@@ -118,50 +130,68 @@ class ControllerBase:
     def first_solve(self):
         sensor_msg = self.get_sensor_msg()
 
-        # retrieve horizon state and acc references
-        horizon_points = self.traj_buffer.get_points(
+        # retrieve horizon state, acc and torque references
+        tau_is_valid = self.traj_buffer.front_is_valid(
+            [PointAttribute.TAU], self.params.horizon_size
+        )
+        x_plan, a_plan, tau_plan = self.traj_buffer.get_horizon(
             self.params.horizon_size, self.point_attributes
         )
-        x_plan = np.zeros([self.params.horizon_size, self.nx])
-        a_plan = np.zeros([self.params.horizon_size, self.nv])
-        for idx_point, point in enumerate(horizon_points):
-            x_plan[idx_point, :] = point.get_x_as_q_v()
-            a_plan[idx_point, :] = point.a
+        u_plan = tau_plan[:-1] if tau_is_valid else None
 
         # First solve
         self.mpc = MPC(self.ocp, x_plan, a_plan, self.rmodel, self.cmodel)
-        x0 = np.concatenate(
-            [sensor_msg.joint_state.position, sensor_msg.joint_state.velocity]
+        self.mpc.mpc_first_step(
+            x_plan, a_plan, self.x0, self.params.horizon_size, u_plan=u_plan
         )
-        self.mpc.mpc_first_step(x_plan, a_plan, x0, self.params.horizon_size)
         self.next_node_idx = self.params.horizon_size
         if self.save_predictions_and_refs:
             self.create_mpc_data()
         _, u, k = self.mpc.get_mpc_output()
         return sensor_msg, u, k
 
-    def solve(self):
-        sensor_msg = self.get_sensor_msg()
-        x0 = np.concatenate(
-            [sensor_msg.joint_state.position, sensor_msg.joint_state.velocity]
-        )
+    def get_next_references(self):
+        """Pop from the buffer the state, acceleration and control references of the node entering the horizon."""
         self.fill_buffer()
-        point = self.traj_buffer.get_points(1, self.point_attributes)[0]
-        new_x_ref = point.get_x_as_q_v()
-        new_a_ref = point.a
+        tau_is_valid = self.traj_buffer.front_is_valid([PointAttribute.TAU])
+        x_plan, a_plan, tau_plan = self.traj_buffer.get_horizon(
+            1, self.point_attributes
+        )
+        if self.next_node_idx < self.mpc.whole_x_plan.shape[0] - 1:
+            self.next_node_idx += 1
+        return x_plan[0], a_plan[0], tau_plan[0] if tau_is_valid else None
 
-        mpc_start_time = time.time()
+    def solve_step(self, x0, new_x_ref, new_a_ref, new_u_ref):
+        """Run an mpc step from x0 with the references of the node entering the horizon."""
         placement_ref = get_ee_pose_from_configuration(
             self.rmodel,
             self.rdata,
             self.last_joint_frame_id,
             new_x_ref[: self.rmodel.nq],
         )
-        self.mpc.mpc_step(x0, new_x_ref, new_a_ref, placement_ref)
+        self.mpc.mpc_step(x0, new_x_ref, new_a_ref, placement_ref, new_u_ref)
+
+    def solve_step_predictions(self, x0, new_x_ref, new_a_ref, new_u_ref):
+        """Run an mpc step and return its predictions, called in the solver process."""
+        self.solve_step(x0, new_x_ref, new_a_ref, new_u_ref)
+        return self.get_predictions()
+
+    def get_predictions(self):
+        """Return copies of the states, controls and gains predicted by the last solve."""
+        return (
+            np.array(self.ocp.solver.xs),
+            np.array(self.ocp.solver.us),
+            np.array(self.ocp.solver.K),
+        )
+
+    def solve(self):
+        sensor_msg = self.get_sensor_msg()
+        new_x_ref, new_a_ref, new_u_ref = self.get_next_references()
+
+        mpc_start_time = time.time()
+        self.solve_step(self.x0, new_x_ref, new_a_ref, new_u_ref)
         mpc_duration = time.time() - mpc_start_time
         rospy.loginfo_throttle(1, "mpc_duration = %s", str(mpc_duration))
-        if self.next_node_idx < self.mpc.whole_x_plan.shape[0] - 1:
-            self.next_node_idx += 1
         if self.save_predictions_and_refs:
             self.fill_predictions_and_refs_arrays()
         _, u, k = self.mpc.get_mpc_output()
@@ -169,59 +199,126 @@ class ControllerBase:
         return sensor_msg, u, k
 
     def get_sensor_msg(self):
-        with self.mutex:
-            sensor_msg = deepcopy(self.sensor_msg)
+        """Return the latest sensor message, its state being copied in self.x0."""
+        _, sensor_msg = self.sensor_state.read(self.x0)
         return sensor_msg
 
     def send(self, sensor_msg, u, k):
-        self.control_msg.header = Header()
-        self.control_msg.header.stamp = rospy.Time.now()
-        self.control_msg.feedback_gain = to_multiarray_f64(k)
-        self.control_msg.feedforward = to_multiarray_f64(u)
-        self.control_msg.initial_state = sensor_msg
-        self.control_publisher.publish(self.control_msg)
+        control_msg = self.control_msg_builder.build(sensor_msg, u, k)
+        self.control_publisher.publish(control_msg)
+
+    def store_solution(self, start_time, sensor_msg, xs, us, K):
+        """Store the predictions of a solve for the publisher thread.
+
+        The solution is replaced by a single reference assignment, the
+        publisher always reading a consistent one.
+        """
+        initial_state = Sensor()
+        initial_state.header = sensor_msg.header
+        initial_state.joint_state.header = sensor_msg.joint_state.header
+        initial_state.joint_state.name = sensor_msg.joint_state.name
+        initial_state.joint_state.effort = sensor_msg.joint_state.effort
+        self.solution = (start_time, xs, us, K, initial_state)
+
+    def get_interpolated_control(self, current_time):
+        """Return the state, control and gain of the last solution interpolated at current_time."""
+        start_time, xs, us, K, initial_state = self.solution
+        node = max((current_time - start_time) / self.ocp.DT, 0.0)
+        idx = min(int(node), us.shape[0] - 1)
+        next_idx = min(idx + 1, us.shape[0] - 1)
+        alpha = min(node - idx, 1.0)
+        x = (1 - alpha) * xs[idx] + alpha * xs[next_idx]
+        u = (1 - alpha) * us[idx] + alpha * us[next_idx]
+        k = (1 - alpha) * K[idx] + alpha * K[next_idx]
+        initial_state.joint_state.position = x[: self.nq].tolist()
+        initial_state.joint_state.velocity = x[self.nq :].tolist()
+        return initial_state, u, k
+
+    def solver_loop(self):
+        """Solve the ocp at the controller rate in the solver process, waiting for it in the solver thread."""
+        while not rospy.is_shutdown():
+            start_compute_time = time.time()
+            start_time = rospy.get_time()
+            sensor_msg = self.get_sensor_msg()
+            xs, us, K = self.solver_process.solve(self.x0, *self.get_next_references())
+            self.store_solution(start_time, sensor_msg, xs, us, K)
+            self.ocp_solve_time = convert_float_to_ros_duration_msg(
+                time.time() - start_compute_time
+            )
+            self.ocp_solve_time_pub.publish(self.ocp_solve_time)
+            self.rate.sleep()
+
+    def publisher_loop(self):
+        """Publish the last solution interpolated in time at the publish rate, logging the jitter of its period."""
+        publish_rate = rospy.Rate(self.params.publish_rate, reset=True)
+        publish_jitter = PeriodJitter(1.0 / self.params.publish_rate)
+        last_log_time = time.time()
+        while not rospy.is_shutdown():
+            start_send_time = time.time()
+            publish_jitter.tick(start_send_time)
+            self.send(*self.get_interpolated_control(rospy.get_time()))
+            self.send_time = convert_float_to_ros_duration_msg(
+                time.time() - start_send_time
+            )
+            self.send_time_pub.publish(self.send_time)
+            if start_send_time - last_log_time > 5.0:
+                statistics = publish_jitter.get_statistics()
+                rospy.loginfo(
+                    "publish period deviation: mean %.1f us, std %.1f us, max %.1f us",
+                    1e6 * statistics["mean"],
+                    1e6 * statistics["std"],
+                    1e6 * statistics["max"],
+                )
+                last_log_time = start_send_time
+            publish_rate.sleep()
 
     def create_mpc_data(self):
-        xs, us = self.mpc.get_predictions()
-        x_ref, p_ref, u_ref = self.mpc.get_reference()
-        self.mpc_data["preds_xs"] = xs[np.newaxis, :]
-        self.mpc_data["preds_us"] = us[np.newaxis, :]
-        self.mpc_data["state_refs"] = x_ref[np.newaxis, :]
-        self.mpc_data["translation_refs"] = p_ref[np.newaxis, :]
-        self.mpc_data["control_refs"] = u_ref[np.newaxis, :]
+        self.mpc_recorder = self.mpc.create_data_recorder("mpc_data")
+        self.mpc.record_predictions_and_refs(self.mpc_recorder)
 
     def fill_predictions_and_refs_arrays(self):
-        xs, us = self.mpc.get_predictions()
-        x_ref, p_ref, u_ref = self.mpc.get_reference()
-        self.mpc_data["preds_xs"] = np.r_[self.mpc_data["preds_xs"], xs[np.newaxis, :]]
-        self.mpc_data["preds_us"] = np.r_[self.mpc_data["preds_us"], us[np.newaxis, :]]
-        self.mpc_data["state_refs"] = np.r_[
-            self.mpc_data["state_refs"], x_ref[np.newaxis, :]
-        ]
-        self.mpc_data["translation_refs"] = np.r_[
-            self.mpc_data["translation_refs"], p_ref[np.newaxis, :]
-        ]
-        self.mpc_data["control_refs"] = np.r_[
-            self.mpc_data["control_refs"], u_ref[np.newaxis, :]
-        ]
+        self.mpc.record_predictions_and_refs(self.mpc_recorder)
 
     def exit_handler(self):
-        np.save("mpc_data.npy", self.mpc_data)
+        self.mpc_recorder.close()
 
     def run(self):
         self.wait_first_sensor_msg()
         self.wait_buffer_has_twice_horizon_points()
         sensor_msg, u, k = self.first_solve()
         input("Press enter to continue ...")
-        self.send(sensor_msg, u, k)
-        self.rate.sleep()
         if self.save_predictions_and_refs:
             atexit.register(self.exit_handler)
+        if self.params.use_solver_process:
+            # The solvers hold the GIL, so the solves run in a process forked
+            # after the first solve, the solver thread only waiting for them,
+            # while this thread keeps publishing the latest solution at a
+            # fixed rate.
+            if self.save_predictions_and_refs:
+                rospy.logwarn(
+                    "The predictions are not recorded with the solver process."
+                )
+            self.store_solution(rospy.get_time(), sensor_msg, *self.get_predictions())
+            self.solver_process = SolverProcess(self.solve_step_predictions)
+            solver_thread = Thread(target=self.solver_loop, daemon=True)
+            solver_thread.start()
+            self.publisher_loop()
+            return
+        self.send(sensor_msg, u, k)
+        self.rate.sleep()
         while not rospy.is_shutdown():
             start_compute_time = time.time()
             sensor_msg, u, k = self.solve()
+            start_send_time = time.time()
             self.send(sensor_msg, u, k)
+            end_send_time = time.time()
             self.rate.sleep()
-            compute_time = time.time() - start_compute_time
-            self.ocp_solve_time = convert_float_to_ros_duration_msg(compute_time)
+            # Solve and message construction plus serialization are timed separately.
+            self.ocp_solve_time = convert_float_to_ros_duration_msg(
+                start_send_time - start_compute_time
+            )
             self.ocp_solve_time_pub.publish(self.ocp_solve_time)
+            self.send_time = convert_float_to_ros_duration_msg(
+                end_send_time - start_send_time
+            )
+            self.send_time_pub.publish(self.send_time)
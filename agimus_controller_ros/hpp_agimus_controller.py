@@ -9,7 +9,10 @@ class HppAgimusController(ControllerBase):
     def __init__(self) -> None:
         super().__init__()
         self.q_goal = [-0.8311, 0.6782, 0.3201, -1.1128, 1.2190, 1.9823, 0.7248]
-        self.hpp_interface = HppInterface()
+        self.hpp_interface = HppInterface(
+            rospy.get_param("~hpp_cache_directory", None),
+            rospy.get_param("~hpp_sampling_threads", 1),
+        )
         self.plan_is_set = False
         self.traj_idx = 0
 
@@ -21,6 +24,7 @@ class HppAgimusController(ControllerBase):
         point.q = self.whole_x_plan[self.traj_idx, : self.nq]
         point.v = self.whole_x_plan[self.traj_idx, self.nq :]
         point.a = self.whole_a_plan[self.traj_idx, :]
+        point.tau = self.whole_u_plan[self.traj_idx, :]
         self.traj_idx = min(self.traj_idx + 1, self.whole_x_plan.shape[0] - 1)
         return point
 
@@ -36,6 +40,9 @@ class HppAgimusController(ControllerBase):
                 ps.client.problem.getPath(ps.numberPaths() - 1),
             )
         )
+        self.whole_u_plan = self.ocp.get_u_ref_table(
+            self.whole_x_plan, self.whole_a_plan
+        )
 
 
 def crocco_motion_server_node():
@@ -1,8 +1,11 @@
 import rospy
+import numpy as np
 from dynamic_graph_bridge_msgs.msg import Vector
+from std_msgs.msg import Float64MultiArray
 from collections import deque
-from threading import Lock
+from threading import Condition, Lock
 from agimus_controller.trajectory_point import TrajectoryPoint
+from agimus_controller.utils.ros_np_multiarray import to_numpy_f64
 
 
 class HPPSubscriberParameters:
@@ -11,6 +14,8 @@ class HPPSubscriberParameters:
         self.name = rospy.get_param("~name", "robot")
         self.prefix = rospy.get_param("~prefix", "agimus")
         self.rate = rospy.get_param("~rate", 100)
+        self.use_chunks = rospy.get_param("~use_chunks", False)
+        self.indexed_samples = rospy.get_param("~indexed_samples", False)
 
 
 class FIFO:
@@ -32,14 +37,145 @@ class FIFO:
             return len(self.deque)
 
 
+def wait_for(condition: Condition, predicate, blocking=True, timeout=None):
+    """Wait until predicate is true, condition being held, and return its last value.
+
+    Args:
+        condition (Condition): Condition notified when predicate may have changed, held by the caller.
+        predicate (callable): Callable returning True when the wait is over.
+        blocking (bool, optional): Wait for predicate to be true, only check it otherwise. Defaults to True.
+        timeout (float, optional): Maximum waiting time in seconds, wait until the node is shut down if None. Defaults to None.
+    """
+    if not blocking:
+        return predicate()
+    if timeout is not None:
+        return condition.wait_for(predicate, timeout)
+    # Wake up regularly to stop waiting when the node is shut down.
+    while not rospy.is_shutdown():
+        if condition.wait_for(predicate, 0.1):
+            return True
+    return False
+
+
+class TrajectoryPointAssembler:
+    """Build trajectory points from position, velocity and acceleration samples matched by key.
+
+    The key of a sample is the stamp of its message header or, with
+    indexed_samples, the index of the sample on the trajectory, sent by
+    the publisher as the last element of the data of the message. Complete
+    points are made available in increasing key order: a sample older than
+    the last complete point is counted as late and ignored, and the
+    incomplete points older than a complete one are counted as dropped.
+
+    The samples older than the last complete point are still kept, up to
+    max_stale_keys keys: if they form a complete point, the publisher has
+    restarted its indices on a new trajectory. The assembler is then reset
+    and this point is the first of the new trajectory. reset can also be
+    called directly when a new trajectory is planned.
+
+    The dynamic_graph_bridge_msgs/Vector messages published by HPP have no
+    header. Without indexed_samples, their samples can only be matched by
+    arrival order on each topic: a lost message then shifts all the
+    following points, and it is neither detected nor counted.
+    """
+
+    fields = ["q", "v", "a"]
+    max_stale_keys = 100
+
+    def __init__(self, indexed_samples=False):
+        self.point_available = Condition()
+        self.indexed_samples = indexed_samples
+        self._pending = {}
+        self._stale = {}
+        self._ready = deque()
+        self._last_key = None
+        self._msg_counters = {field: 0 for field in self.fields}
+        self.nb_dropped = 0
+        self.nb_late = 0
+
+    def _get_key_and_data(self, field, msg):
+        if msg._has_header:
+            return msg.header.stamp, msg.data
+        if self.indexed_samples:
+            return int(round(msg.data[-1])), msg.data[:-1]
+        # Arrival order.
+        key = self._msg_counters[field]
+        self._msg_counters[field] += 1
+        return key, msg.data
+
+    def add_sample(self, field, msg):
+        """Add the sample of a field, called from the subscriber callbacks."""
+        with self.point_available:
+            key, data = self._get_key_and_data(field, msg)
+            if self._last_key is not None and key <= self._last_key:
+                if not self._add_stale_sample(key, field, data):
+                    return
+                # A complete point older than the last one, the indices
+                # restarted on a new trajectory.
+                sample = self._stale[key]
+                self._reset()
+            else:
+                sample = self._pending.setdefault(key, {})
+                sample[field] = data
+                if len(sample) < len(self.fields):
+                    return
+                del self._pending[key]
+            for old_key in [k for k in self._pending if k < key]:
+                del self._pending[old_key]
+                self.nb_dropped += 1
+            self._ready.append(sample)
+            self._last_key = key
+            self.point_available.notify()
+
+    def _add_stale_sample(self, key, field, data):
+        """Keep a sample older than the last complete point and return True if it completes a point."""
+        stale = self._stale.setdefault(key, {})
+        stale[field] = data
+        if len(stale) == len(self.fields):
+            # Its other samples were counted as late.
+            self.nb_late -= len(self.fields) - 1
+            return True
+        self.nb_late += 1
+        if len(self._stale) > self.max_stale_keys:
+            del self._stale[next(iter(self._stale))]
+        return False
+
+    def _reset(self):
+        for _ in self._pending:
+            self.nb_dropped += 1
+        self._pending = {}
+        self._stale = {}
+        self._last_key = None
+        self._msg_counters = {field: 0 for field in self.fields}
+
+    def reset(self):
+        """Forget the incomplete points and the last key, for the samples of a new trajectory starting again from index 0."""
+        with self.point_available:
+            self._reset()
+
+    def get_size(self):
+        with self.point_available:
+            return len(self._ready)
+
+    def _point_is_available(self):
+        return len(self._ready) > 0
+
+    def pop_sample(self, blocking=True, timeout=None):
+        """Return the (q, v, a) of the next complete point, or None if none is available."""
+        with self.point_available:
+            if not wait_for(
+                self.point_available, self._point_is_available, blocking, timeout
+            ):
+                return None
+            sample = self._ready.popleft()
+        return sample["q"], sample["v"], sample["a"]
+
+
 class HPPSubscriber:
     def __init__(self) -> None:
         rospy.loginfo("Load parameters")
         self.params = HPPSubscriberParameters()
 
-        rospy.loginfo("Create the rate object.")
-        self.wait_subscribers = rospy.Rate(10000)  # 10kHz
-
         rospy.loginfo("Parse the prefix/name params.")
         if not self.params.prefix.endswith("/"):
             self.params.prefix = self.params.prefix + "/"
@@ -48,19 +184,38 @@ class HPPSubscriber:
         self.params.name.replace("/", "")
 
         rospy.loginfo("Create FIFO for all elements of trajectory_point")
-        self.fifo_q = FIFO()  # q
-        self.fifo_v = FIFO()  # v
-        self.fifo_a = FIFO()  # a
+        self.point_assembler = TrajectoryPointAssembler(
+            self.params.indexed_samples
+        )  # q, v, a
+        if not self.params.indexed_samples and not self.params.use_chunks:
+            rospy.logwarn(
+                "The trajectory samples are matched by arrival order, a lost "
+                "message would shift all the following points."
+            )
         self.fifo_com_pose = FIFO()  # com_pos
         self.fifo_com_velocity = FIFO()  # com_vel
         self.fifo_op_frame_pose = FIFO()  # op_pos
         self.fifo_op_frame_velocity = FIFO()  # op_vel
 
+        # Chunks of N stacked (q, v, a) samples.
+        self.chunk_available = Condition()
+        self.chunks = deque()
+
         self.index = 0
 
         rospy.loginfo("Spawn the subscribers.")
         self.subscribers = []
 
+        if self.params.use_chunks:
+            rospy.loginfo("\t- Trajectory chunk subscriber.")
+            self.subscribers += [
+                rospy.Subscriber(
+                    "/hpp/target/chunk",
+                    Float64MultiArray,
+                    self.chunk_callback,
+                )
+            ]
+            return
         # q
         rospy.loginfo("\t- Robot configuration subscriber.")
         self.subscribers += [
@@ -129,16 +284,22 @@ class HPPSubscriber:
     # get q, v, a avec pubQ, pubV, pubA qui sont publish dans le fichier discretization.cc
 
     def print_fifo(self):
-        print(self.fifo_q.get_size())
+        print(self.point_assembler.get_size())
 
     def position_callback(self, msg):
-        self.fifo_q.push_back(msg)
+        self.point_assembler.add_sample("q", msg)
 
     def velocity_callback(self, msg):
-        self.fifo_v.push_back(msg)
+        self.point_assembler.add_sample("v", msg)
 
     def acceleration_callback(self, msg):
-        self.fifo_a.push_back(msg)
+        self.point_assembler.add_sample("a", msg)
+
+    def chunk_callback(self, msg):
+        chunk = to_numpy_f64(msg)
+        with self.chunk_available:
+            self.chunks.append(chunk)
+            self.chunk_available.notify()
 
     def com_pose_callback(self, msg):
         rospy.logdebug("CoM pos msg = ", msg)
@@ -154,27 +315,30 @@ class HPPSubscriber:
         self.fifo_op_frame_pose.push_back(msg)
 
     def min_all_deque(self):
-        return min(
-            self.fifo_q.get_size(),
-            self.fifo_v.get_size(),
-            self.fifo_a.get_size(),
-            # self.fifo_com_pose.get_size(),
-            # self.fifo_com_velocity.get_size(),
-            # self.fifo_op_frame_pose.get_size(),
-            # self.fifo_op_frame_velocity.get_size()
-        )
-
-    def get_trajectory_point(self):
-        while self.min_all_deque() == 0:
-            self.wait_subscribers.sleep()
-            print("min all deque size : ", self.min_all_deque())
-
-        q = self.fifo_q.pop_front().data
-        v = self.fifo_v.pop_front().data
+        return self.point_assembler.get_size()
+
+    def get_trajectory_point(self, blocking=True, timeout=None):
+        """Return the next trajectory point, or None if none is available.
+
+        Args:
+            blocking (bool, optional): Wait for a point to be available. Defaults to True.
+            timeout (float, optional): Maximum waiting time in seconds, wait until the node is shut down if None. Defaults to None.
+        """
+        sample = self.point_assembler.pop_sample(blocking, timeout)
+        if sample is None:
+            return None
+        q, v, a = sample
+        if self.point_assembler.nb_dropped or self.point_assembler.nb_late:
+            rospy.logwarn_throttle(
+                1,
+                "%d incomplete trajectory points dropped, %d late samples ignored",
+                self.point_assembler.nb_dropped,
+                self.point_assembler.nb_late,
+            )
         tp = TrajectoryPoint(time=self.index, nq=len(q), nv=len(v))
-        tp.q[:] = q[:]
-        tp.v[:] = v[:]
-        tp.a[:] = self.fifo_a.pop_front().data[:]
+        tp.q = q
+        tp.v = v
+        tp.a = a
         # tp.com_pos = self.fifo_com_pose.pop_front().data
         # tp.com_vel = self.fifo_com_velocity.pop_front().data
         # tp.op_pos = self.fifo_op_frame_pose.pop_front().data
@@ -182,3 +346,23 @@ class HPPSubscriber:
 
         self.index += 1
         return tp
+
+    def _chunk_is_available(self):
+        return len(self.chunks) > 0
+
+    def get_trajectory_chunk(self, blocking=True, timeout=None):
+        """Return the times and the (N, nq + 2 * nv) array of stacked (q, v, a) of the next chunk, or None if none is available.
+
+        Args:
+            blocking (bool, optional): Wait for a chunk to be available. Defaults to True.
+            timeout (float, optional): Maximum waiting time in seconds, wait until the node is shut down if None. Defaults to None.
+        """
+        with self.chunk_available:
+            if not wait_for(
+                self.chunk_available, self._chunk_is_available, blocking, timeout
+            ):
+                return None
+            chunk = self.chunks.popleft()
+        times = np.arange(self.index, self.index + chunk.shape[0])
+        self.index += chunk.shape[0]
+        return times, chunk
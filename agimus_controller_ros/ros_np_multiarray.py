@@ -1,42 +1,41 @@
 import numpy as np
-from functools import partial
-
-from std_msgs.msg import MultiArrayDimension
+from std_msgs.msg import MultiArrayDimension, MultiArrayLayout
 from std_msgs.msg import Float64MultiArray
 
+from functools import lru_cache, partial
+
+
+@lru_cache(maxsize=None)
+def _get_dims(shape):
+    """Return the (label, size, stride) of the row-major dimensions of an array of this shape."""
+    if len(shape) == 1:
+        return (("row", shape[0], shape[0]), ("col", 1, 1))
+    # len(shape) == 2
+    return (("row", shape[0], shape[0] * shape[1]), ("col", shape[1], shape[1]))
+
+
+def _get_layout(shape):
+    """Return a new layout of an array of this shape, only its dimensions values being cached."""
+    layout = MultiArrayLayout()
+    layout.dim = [
+        MultiArrayDimension(label=label, size=size, stride=stride)
+        for label, size, stride in _get_dims(shape)
+    ]
+    return layout
+
 
 def _numpy_to_multiarray(multiarray_type, np_array):
     multiarray = multiarray_type()
-
-    row_dim = MultiArrayDimension()
-    col_dim = MultiArrayDimension()
-    row_dim.label = "row"
-    col_dim.label = "col"
-    if len(np_array.shape) == 1:
-        row_dim.stride = np_array.size
-        row_dim.size = np_array.shape[0]
-        col_dim.stride = 1
-        col_dim.size = 1
-    else:  # len(np_array.shape) == 2
-        row_dim.stride = np_array.size
-        row_dim.size = np_array.shape[0]
-        col_dim.stride = np_array.shape[1]
-        col_dim.size = np_array.shape[1]
-    multiarray.layout.dim = [row_dim, col_dim]
-    multiarray.data = []
-    for i in range(np_array.shape[0]):
-        if col_dim.size == 1:
-            multiarray.data.append(np_array[i])
-        else:
-            for j in range(np_array.shape[1]):
-                multiarray.data.append(np_array[i, j])
+    multiarray.layout = _get_layout(np_array.shape)
+    multiarray.data = np_array.ravel().tolist()
     return multiarray
 
 
-def _multiarray_to_numpy(pytype, dtype, multiarray):
+def _multiarray_to_numpy(dtype, multiarray):
+    """Return the array of the multiarray data, without copy if it is already a numpy array of dtype."""
     dims = tuple(map(lambda x: x.size, multiarray.layout.dim))
-    return np.array(multiarray.data, dtype=pytype).reshape(dims).astype(dtype)
+    return np.asarray(multiarray.data, dtype=dtype).reshape(dims)
 
 
 to_multiarray_f64 = partial(_numpy_to_multiarray, Float64MultiArray)
-to_numpy_f64 = partial(_multiarray_to_numpy, float, np.float64)
+to_numpy_f64 = partial(_multiarray_to_numpy, np.float64)
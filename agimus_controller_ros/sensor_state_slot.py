@@ -0,0 +1,30 @@
+import numpy as np
+from linear_feedback_controller_msgs.msg import Sensor
+
+
+class SensorStateSlot:
+    """Latest robot state received, shared between the sensor callback and the control loop.
+
+    rospy creates a new message for each callback, so the callback only
+    stores a reference to it, with a single atomic assignment, and the
+    message is never modified afterwards. The reader converts the state of
+    the message it took, which is therefore always complete and consistent
+    with the message returned, without any lock.
+    """
+
+    def __init__(self, nq: int, nv: int) -> None:
+        self.nq = nq
+        self._latest = Sensor()
+        self._latest.joint_state.position = [0.0] * nq
+        self._latest.joint_state.velocity = [0.0] * nv
+
+    def write(self, sensor_msg):
+        """Store the sensor message, called from the sensor callback."""
+        self._latest = sensor_msg
+
+    def read(self, x0: np.ndarray):
+        """Copy the state of the latest sensor message in x0 and return its stamp and the message."""
+        sensor_msg = self._latest
+        x0[: self.nq] = sensor_msg.joint_state.position
+        x0[self.nq :] = sensor_msg.joint_state.velocity
+        return sensor_msg.header.stamp, sensor_msg